@@ -108,8 +108,11 @@ def run_migrations_offline() -> None:
 def do_run_migrations(connection: Connection) -> None:
     """Run migrations within a connection context.
 
-    Uses a PostgreSQL transaction-scoped advisory lock to prevent concurrent
+    Uses a PostgreSQL session-scoped advisory lock to prevent concurrent
     migrations from deadlocking when multiple containers start simultaneously.
+    The lock is session-scoped (not xact) because migrations that build indexes
+    CONCURRENTLY commit mid-run via autocommit_block(); it is released when the
+    connection closes (NullPool).
 
     IMPORTANT: The advisory lock MUST be acquired inside begin_transaction(),
     not before context.configure(). Executing any SQL before configure() triggers
@@ -127,10 +130,11 @@ def do_run_migrations(connection: Connection) -> None:
     )
 
     with context.begin_transaction():
-        # Acquire transaction-scoped advisory lock inside the transaction.
-        # pg_advisory_xact_lock auto-releases when the transaction commits/rolls back.
+        # Acquire session-scoped advisory lock inside the transaction.
+        # pg_advisory_lock survives the commits done by autocommit_block() and
+        # auto-releases when the connection closes.
         if connection.dialect.name == "postgresql":
-            connection.execute(text("SELECT pg_advisory_xact_lock(7483920165)"))
+            connection.execute(text("SELECT pg_advisory_lock(7483920165)"))
         context.run_migrations()
 
 
@@ -1,15 +1,25 @@
-"""Add composite index for chat_id + date DESC to optimize message pagination.
+"""Add composite index for chat_id + date DESC + id DESC to optimize message pagination.
 
 Revision ID: 002
 Revises: 001
 Create Date: 2026-01-16
 
 This index dramatically improves query performance for the viewer's
-message pagination which uses:
-    WHERE chat_id = ? ORDER BY date DESC LIMIT 50 OFFSET ?
+message pagination which uses keyset (cursor) pagination:
+    WHERE chat_id = ? AND (date, id) < (?, ?) ORDER BY date DESC, id DESC LIMIT 50
 
 Without this index, PostgreSQL/SQLite must scan the entire messages table
-and sort results. With the index, it can do an index-only scan.
+and sort results. With the index, it can do an index-only scan. The trailing
+id DESC is the tie-breaker for messages sharing the same date, so the index
+order matches the ORDER BY exactly and deep pages cost the same as the first.
+
+On PostgreSQL the index also carries sender_id and reply_to_msg_id
+as INCLUDE columns, so queries that only need those can be answered with an
+index-only scan. Index-only scans depend on the visibility map, so run
+VACUUM (ANALYZE) messages after creating it on a large existing table rather
+than waiting for autovacuum. message text is deliberately not included: long
+messages would exceed the btree tuple size limit and fail on insert. is_pinned
+only exists from revision 004 on; migration 007 adds it to the INCLUDE list.
 
 Performance impact: 10-100x faster for large chats (10k+ messages).
 """
@@ -28,13 +38,41 @@ depends_on: str | Sequence[str] | None = None
 
 
 def upgrade() -> None:
-    """Add composite index on (chat_id, date DESC) for fast message pagination."""
+    """Add composite index on (chat_id, date DESC, id DESC) for fast message pagination."""
     # This index covers the most common query pattern in the viewer:
-    # SELECT * FROM messages WHERE chat_id = ? ORDER BY date DESC LIMIT 50
+    # SELECT * FROM messages WHERE chat_id = ? ORDER BY date DESC, id DESC LIMIT 50
     #
-    # The DESC on date is important - it matches the ORDER BY direction,
+    # The DESC on date/id is important - it matches the ORDER BY direction,
     # allowing PostgreSQL to read the index in order without sorting.
-    op.create_index("idx_messages_chat_date_desc", "messages", ["chat_id", sa.text("date DESC")], unique=False)
+    if op.get_bind().dialect.name == "postgresql":
+        # A plain CREATE INDEX blocks all writes to messages until the build finishes.
+        # CONCURRENTLY costs an extra table pass but lets the backup keep writing.
+        # It cannot run inside a transaction, hence the autocommit block.
+        with op.get_context().autocommit_block():
+            # IF NOT EXISTS would keep an INVALID index left by an interrupted build
+            # (offline --sql runs cannot inspect the schema)
+            invalid = not op.get_context().as_sql and op.get_bind().execute(
+                sa.text("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"),
+                {"name": "idx_messages_chat_date_desc"},
+            ).scalar()
+            if invalid:
+                op.drop_index("idx_messages_chat_date_desc", table_name="messages", postgresql_concurrently=True)
+            op.create_index(
+                "idx_messages_chat_date_desc",
+                "messages",
+                [sa.text("chat_id"), sa.text("date DESC"), sa.text("id DESC")],
+                unique=False,
+                postgresql_include=["sender_id", "reply_to_msg_id"],
+                postgresql_concurrently=True,
+                if_not_exists=True,
+            )
+    else:
+        op.create_index(
+            "idx_messages_chat_date_desc",
+            "messages",
+            [sa.text("chat_id"), sa.text("date DESC"), sa.text("id DESC")],
+            unique=False,
+        )
 
 
 def downgrade() -> None:
@@ -27,7 +27,9 @@ def upgrade() -> None:
         sa.Column("endpoint", sa.Text(), nullable=False),
         sa.Column("p256dh", sa.String(255), nullable=False),
         sa.Column("auth", sa.String(255), nullable=False),
-        sa.Column("chat_id", sa.BigInteger(), nullable=True),
+        # Chat-specific subscriptions go away with their chat; idx_push_sub_chat
+        # below serves the cascade lookup
+        sa.Column("chat_id", sa.BigInteger(), sa.ForeignKey("chats.id", ondelete="CASCADE"), nullable=True),
         sa.Column("user_agent", sa.String(500), nullable=True),
         sa.Column("created_at", sa.DateTime(), server_default=sa.func.now(), nullable=False),
         sa.Column("last_used_at", sa.DateTime(), nullable=True),
@@ -24,8 +24,19 @@ def upgrade() -> None:
     # Add is_pinned column with default 0 (not pinned)
     op.add_column("messages", sa.Column("is_pinned", sa.Integer(), nullable=False, server_default="0"))
 
-    # Create composite index for efficient pinned message queries per chat
-    op.create_index("idx_messages_chat_pinned", "messages", ["chat_id", "is_pinned"])
+    # Partial index for efficient pinned message queries per chat. Almost every row
+    # has is_pinned = 0, so only indexing pinned rows keeps the index tiny.
+    # Queries must spell the predicate as a literal (is_pinned = 1), not a bound
+    # parameter, for the planner to match it against the index WHERE clause.
+    # Plain CREATE INDEX in the migration transaction: the ADD COLUMN above can't be
+    # repeated, so the revision must not commit halfway (see migration 007).
+    op.create_index(
+        "idx_messages_chat_pinned",
+        "messages",
+        ["chat_id"],
+        sqlite_where=sa.text("is_pinned = 1"),
+        postgresql_where=sa.text("is_pinned = 1"),
+    )
 
 
 def downgrade() -> None:
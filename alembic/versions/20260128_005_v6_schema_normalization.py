@@ -81,30 +81,85 @@ def upgrade() -> None:
         )
 
     # Update existing media records that might be missing message_id/chat_id
-    conn.execute(
-        text("""
-        UPDATE media
-        SET message_id = (
-            SELECT m.id FROM messages m WHERE m.media_id = media.id LIMIT 1
-        ),
-        chat_id = (
-            SELECT m.chat_id FROM messages m WHERE m.media_id = media.id LIMIT 1
+    # Set-based: one pass over messages instead of correlated subqueries per media row
+    if dialect == "postgresql":
+        conn.execute(
+            text("""
+            UPDATE media
+            SET message_id = m.id, chat_id = m.chat_id
+            FROM (
+                SELECT DISTINCT ON (media_id) media_id, id, chat_id
+                FROM messages
+                WHERE media_id IS NOT NULL AND media_id != ''
+                ORDER BY media_id, id
+            ) m
+            WHERE m.media_id = media.id
+              AND media.message_id IS NULL
+        """)
         )
-        WHERE message_id IS NULL
-          AND EXISTS (SELECT 1 FROM messages m WHERE m.media_id = media.id)
-    """)
-    )
+    else:
+        # SQLite: messages.media_id is not indexed, so every correlated lookup would
+        # be a full scan. Build a throwaway partial index just for this statement.
+        conn.execute(
+            text("""
+            CREATE INDEX tmp_msg_media_id ON messages (media_id)
+            WHERE media_id IS NOT NULL AND media_id != ''
+        """)
+        )
+        conn.execute(
+            text("""
+            UPDATE media
+            SET (message_id, chat_id) = (
+                SELECT m.id, m.chat_id FROM messages m
+                WHERE m.media_id = media.id AND m.media_id IS NOT NULL AND m.media_id != ''
+                ORDER BY m.id
+                LIMIT 1
+            )
+            WHERE message_id IS NULL
+              AND EXISTS (
+                  SELECT 1 FROM messages m
+                  WHERE m.media_id = media.id AND m.media_id IS NOT NULL AND m.media_id != ''
+              )
+        """)
+        )
+        conn.execute(text("DROP INDEX tmp_msg_media_id"))
 
     # =========================================================================
     # STEP 2: Create backup table for rollback (stores dropped columns)
     # =========================================================================
 
+    # Probe first: on a fresh database there is nothing to back up, so skip the
+    # full scan of messages and just create the empty table for the downgrade.
+    # Offline (--sql) runs cannot probe, so they always emit the copy.
+    has_media = op.get_context().as_sql or conn.execute(
+        text("SELECT 1 FROM messages WHERE media_id IS NOT NULL AND media_id != '' LIMIT 1")
+    ).scalar()
+    if has_media is None:
+        op.execute(
+            text("""
+            CREATE TABLE IF NOT EXISTS _messages_media_backup (
+                id BIGINT,
+                chat_id BIGINT,
+                media_type VARCHAR(50),
+                media_id VARCHAR(255),
+                media_path VARCHAR(500)
+            )
+        """)
+        )
+    else:
+        op.execute(
+            text("""
+            CREATE TABLE IF NOT EXISTS _messages_media_backup AS
+            SELECT id, chat_id, media_type, media_id, media_path
+            FROM messages
+            WHERE media_id IS NOT NULL AND media_id != ''
+        """)
+        )
+    # Key the backup like messages so the downgrade restore can join on it
     op.execute(
         text("""
-        CREATE TABLE IF NOT EXISTS _messages_media_backup AS
-        SELECT id, chat_id, media_type, media_id, media_path
-        FROM messages
-        WHERE media_id IS NOT NULL AND media_id != ''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_media_backup_pk
+        ON _messages_media_backup (id, chat_id)
     """)
     )
 
@@ -115,6 +170,14 @@ def upgrade() -> None:
     # SQLite doesn't support DROP COLUMN directly in older versions
     # We need to handle this differently based on dialect
     if dialect == "sqlite":
+        # The rebuilds below copy every message and media row. A larger page cache
+        # (64 MiB) keeps both the source and target b-trees in memory during the copy.
+        # journal_mode/synchronous are deliberately left alone: the old tables are
+        # dropped in this same transaction, so the journal is the only way back if
+        # the process dies mid-migration. All statements share one transaction, so
+        # there is a single fsync at commit regardless of how many we issue.
+        op.execute(text("PRAGMA cache_size = -65536"))
+
         # SQLite: Recreate table without the columns
         # First, create new table structure
         # NOTE: sender_id FK is NOT enforced because sender_id can be channel/group IDs
@@ -141,7 +204,9 @@ def upgrade() -> None:
         """)
         )
 
-        # Copy data
+        # Copy data. messages_new carries only its PK at this point: secondary
+        # indexes are built after the copy, which is a sorted bulk build rather
+        # than per-row b-tree maintenance. Keep any new index out of CREATE TABLE.
         op.execute(
             text("""
             INSERT INTO messages_new (
@@ -161,12 +226,18 @@ def upgrade() -> None:
         op.execute(text("DROP TABLE messages"))
         op.execute(text("ALTER TABLE messages_new RENAME TO messages"))
 
-        # Recreate indexes
-        op.create_index("idx_messages_chat_id", "messages", ["chat_id"])
+        # Recreate indexes (only now that the data is loaded). idx_messages_chat_id
+        # is not recreated: chat_id is the leading column of idx_messages_chat_date_desc,
+        # which serves every WHERE chat_id = ? lookup. idx_messages_date stays for
+        # cross-chat date range exports.
         op.create_index("idx_messages_date", "messages", ["date"])
         op.create_index("idx_messages_sender_id", "messages", ["sender_id"])
-        op.create_index("idx_messages_chat_date_desc", "messages", ["chat_id", sa.text("date DESC")])
-        op.create_index("idx_messages_chat_pinned", "messages", ["chat_id", "is_pinned"])
+        op.create_index(
+            "idx_messages_chat_date_desc",
+            "messages",
+            [sa.text("chat_id"), sa.text("date DESC"), sa.text("id DESC")],
+        )
+        op.create_index("idx_messages_chat_pinned", "messages", ["chat_id"], sqlite_where=sa.text("is_pinned = 1"))
     else:
         # PostgreSQL: Direct column drops
         # NOTE: sender_id FK is NOT added because sender_id can be channel/group IDs
@@ -175,23 +246,44 @@ def upgrade() -> None:
         op.drop_column("messages", "media_id")
         op.drop_column("messages", "media_path")
 
+        # Redundant with idx_messages_chat_date_desc (chat_id is its leading column)
+        op.drop_index("idx_messages_chat_id", table_name="messages", if_exists=True)
+
     # =========================================================================
     # STEP 4: Clean up orphan data before adding FK constraints
     # =========================================================================
 
-    # Delete orphan media records (where message doesn't exist)
-    conn.execute(
-        text("""
-        DELETE FROM media
-        WHERE message_id IS NOT NULL
-          AND chat_id IS NOT NULL
-          AND NOT EXISTS (
-              SELECT 1 FROM messages
-              WHERE messages.id = media.message_id
-                AND messages.chat_id = media.chat_id
-          )
-    """)
-    )
+    # Delete orphan media records (where message doesn't exist), written as an
+    # explicit anti-join so it is one join pass rather than a probe per media row
+    if dialect == "postgresql":
+        conn.execute(
+            text("""
+            DELETE FROM media
+            USING (
+                SELECT m.id
+                FROM media m
+                LEFT JOIN messages x ON x.id = m.message_id AND x.chat_id = m.chat_id
+                WHERE m.message_id IS NOT NULL
+                  AND m.chat_id IS NOT NULL
+                  AND x.id IS NULL
+            ) orphans
+            WHERE media.id = orphans.id
+        """)
+        )
+    else:
+        conn.execute(
+            text("""
+            DELETE FROM media
+            WHERE id IN (
+                SELECT m.id
+                FROM media m
+                LEFT JOIN messages x ON x.id = m.message_id AND x.chat_id = m.chat_id
+                WHERE m.message_id IS NOT NULL
+                  AND m.chat_id IS NOT NULL
+                  AND x.id IS NULL
+            )
+        """)
+        )
 
     # Set user_id to NULL for orphan reactions (where user doesn't exist)
     # This preserves the reaction counts while removing invalid FK references
@@ -234,20 +326,33 @@ def upgrade() -> None:
 
         op.execute(
             text("""
-            INSERT INTO media_new
-            SELECT * FROM media
+            INSERT INTO media_new (
+                id, message_id, chat_id, type, file_path, file_name, file_size,
+                mime_type, width, height, duration, downloaded, download_date, created_at
+            )
+            SELECT
+                id, message_id, chat_id, type, file_path, file_name, file_size,
+                mime_type, width, height, duration, downloaded, download_date, created_at
+            FROM media
         """)
         )
 
         op.execute(text("DROP TABLE media"))
         op.execute(text("ALTER TABLE media_new RENAME TO media"))
 
-        # Recreate media indexes
+        # Recreate media indexes (after the copy, as for messages)
         op.create_index("idx_media_message", "media", ["message_id", "chat_id"])
     else:
-        # PostgreSQL: Add FK directly
-        op.create_foreign_key(
-            "fk_media_message", "media", "messages", ["message_id", "chat_id"], ["id", "chat_id"], ondelete="CASCADE"
+        # PostgreSQL: Add FK as NOT VALID - new writes are checked immediately, but the
+        # scan of existing rows is left to VALIDATE CONSTRAINT in migration 007, which
+        # runs outside the migration transaction under a lock that does not block
+        # reads or writes.
+        op.execute(
+            text("""
+            ALTER TABLE media
+            ADD CONSTRAINT fk_media_message FOREIGN KEY (message_id, chat_id)
+            REFERENCES messages (id, chat_id) ON DELETE CASCADE NOT VALID
+        """)
         )
 
     # =========================================================================
@@ -255,29 +360,83 @@ def upgrade() -> None:
     # =========================================================================
 
     if dialect != "sqlite":
-        op.create_foreign_key("fk_reactions_user", "reactions", "users", ["user_id"], ["id"], ondelete="SET NULL")
+        # NOT VALID as for fk_media_message; validated in migration 007
+        op.execute(
+            text("""
+            ALTER TABLE reactions
+            ADD CONSTRAINT fk_reactions_user FOREIGN KEY (user_id)
+            REFERENCES users (id) ON DELETE SET NULL NOT VALID
+        """)
+        )
 
     # =========================================================================
     # STEP 7: Add new performance indexes
     # =========================================================================
 
-    # Index for reply lookups
-    op.create_index("idx_messages_reply_to", "messages", ["chat_id", "reply_to_msg_id"])
+    # Plain CREATE INDEX inside the migration transaction, so a failure anywhere in
+    # this revision rolls all of it back and 005 can simply be run again. The
+    # CONCURRENTLY rebuilds of indexes whose definition changed live in 007.
+    if dialect == "postgresql":
+        # More sort memory for the btree builds, for this transaction only; kept
+        # moderate so small hosts running the archive don't swap.
+        op.execute(text("SET LOCAL maintenance_work_mem = '256MB'"))
+    _create_performance_indexes()
+
+    # Refresh planner statistics once, after all rewrites and index builds, so the
+    # new indexes are picked up immediately instead of after the next autovacuum.
+    for table in ("messages", "media", "reactions", "chats", "users"):
+        op.execute(text(f"ANALYZE {table}"))
+
+
+def _create_performance_indexes(**kw) -> None:
+    """Create the v6.0.0 performance indexes, passing extra options to every create_index."""
+    # Index for reply lookups ("replies to message X", newest first). Trailing
+    # date/id match ORDER BY date DESC, id DESC; partial since most messages aren't replies.
+    op.create_index(
+        "idx_messages_reply_to",
+        "messages",
+        [sa.text("chat_id"), sa.text("reply_to_msg_id"), sa.text("date DESC"), sa.text("id DESC")],
+        sqlite_where=sa.text("reply_to_msg_id IS NOT NULL"),
+        postgresql_where=sa.text("reply_to_msg_id IS NOT NULL"),
+        **kw,
+    )
 
-    # Index for finding undownloaded media
-    op.create_index("idx_media_downloaded", "media", ["chat_id", "downloaded"])
+    # Index for per-chat media lookups by download state
+    op.create_index("idx_media_downloaded", "media", ["chat_id", "downloaded"], **kw)
 
     # Index for filtering by media type
-    op.create_index("idx_media_type", "media", ["type"])
-
-    # Index for user reaction queries
-    op.create_index("idx_reactions_user", "reactions", ["user_id"])
-
-    # Index for chat username lookups
-    op.create_index("idx_chats_username", "chats", ["username"])
+    op.create_index("idx_media_type", "media", ["type"], **kw)
+
+    # Index for user reaction queries and the fk_reactions_user SET NULL lookup.
+    # Partial: aggregated/anonymous reactions have no user_id and never match.
+    op.create_index(
+        "idx_reactions_user",
+        "reactions",
+        ["user_id"],
+        sqlite_where=sa.text("user_id IS NOT NULL"),
+        postgresql_where=sa.text("user_id IS NOT NULL"),
+        **kw,
+    )
 
-    # Index for user username lookups
-    op.create_index("idx_users_username", "users", ["username"])
+    # Indexes for chat/user username lookups. Partial: most users and private chats
+    # have no username. Not UNIQUE: usernames are released and reused on Telegram,
+    # so the archive legitimately keeps stale duplicates.
+    op.create_index(
+        "idx_chats_username",
+        "chats",
+        ["username"],
+        sqlite_where=sa.text("username IS NOT NULL"),
+        postgresql_where=sa.text("username IS NOT NULL"),
+        **kw,
+    )
+    op.create_index(
+        "idx_users_username",
+        "users",
+        ["username"],
+        sqlite_where=sa.text("username IS NOT NULL"),
+        postgresql_where=sa.text("username IS NOT NULL"),
+        **kw,
+    )
 
 
 def downgrade() -> None:
@@ -311,6 +470,9 @@ def downgrade() -> None:
     # =========================================================================
 
     if dialect == "sqlite":
+        # Larger page cache for the table copies (see upgrade STEP 3)
+        op.execute(text("PRAGMA cache_size = -65536"))
+
         # SQLite: Recreate messages table with media columns
         op.execute(
             text("""
@@ -355,12 +517,16 @@ def downgrade() -> None:
         op.execute(text("DROP TABLE messages"))
         op.execute(text("ALTER TABLE messages_new RENAME TO messages"))
 
-        # Recreate indexes
+        # Recreate indexes (only now that the data is loaded)
         op.create_index("idx_messages_chat_id", "messages", ["chat_id"])
         op.create_index("idx_messages_date", "messages", ["date"])
         op.create_index("idx_messages_sender_id", "messages", ["sender_id"])
-        op.create_index("idx_messages_chat_date_desc", "messages", ["chat_id", sa.text("date DESC")])
-        op.create_index("idx_messages_chat_pinned", "messages", ["chat_id", "is_pinned"])
+        op.create_index(
+            "idx_messages_chat_date_desc",
+            "messages",
+            [sa.text("chat_id"), sa.text("date DESC"), sa.text("id DESC")],
+        )
+        op.create_index("idx_messages_chat_pinned", "messages", ["chat_id"], sqlite_where=sa.text("is_pinned = 1"))
 
         # Recreate media table without FK
         op.execute(
@@ -384,7 +550,18 @@ def downgrade() -> None:
         """)
         )
 
-        op.execute(text("INSERT INTO media_new SELECT * FROM media"))
+        op.execute(
+            text("""
+            INSERT INTO media_new (
+                id, message_id, chat_id, type, file_path, file_name, file_size,
+                mime_type, width, height, duration, downloaded, download_date, created_at
+            )
+            SELECT
+                id, message_id, chat_id, type, file_path, file_name, file_size,
+                mime_type, width, height, duration, downloaded, download_date, created_at
+            FROM media
+        """)
+        )
         op.execute(text("DROP TABLE media"))
         op.execute(text("ALTER TABLE media_new RENAME TO media"))
         op.create_index("idx_media_message", "media", ["message_id", "chat_id"])
@@ -393,22 +570,22 @@ def downgrade() -> None:
         op.add_column("messages", sa.Column("media_type", sa.String(50)))
         op.add_column("messages", sa.Column("media_id", sa.String(255)))
         op.add_column("messages", sa.Column("media_path", sa.String(500)))
+        op.create_index("idx_messages_chat_id", "messages", ["chat_id"], if_not_exists=True)
 
     # =========================================================================
     # STEP 4: Restore data from backup table
     # =========================================================================
 
+    # Single join pass - UPDATE ... FROM works on PostgreSQL and SQLite 3.33+
     conn.execute(
         text("""
         UPDATE messages
         SET
-            media_type = (SELECT media_type FROM _messages_media_backup b WHERE b.id = messages.id AND b.chat_id = messages.chat_id),
-            media_id = (SELECT media_id FROM _messages_media_backup b WHERE b.id = messages.id AND b.chat_id = messages.chat_id),
-            media_path = (SELECT media_path FROM _messages_media_backup b WHERE b.id = messages.id AND b.chat_id = messages.chat_id)
-        WHERE EXISTS (
-            SELECT 1 FROM _messages_media_backup b
-            WHERE b.id = messages.id AND b.chat_id = messages.chat_id
-        )
+            media_type = b.media_type,
+            media_id = b.media_id,
+            media_path = b.media_path
+        FROM _messages_media_backup b
+        WHERE b.id = messages.id AND b.chat_id = messages.chat_id
     """)
     )
 
@@ -40,14 +40,32 @@ def upgrade() -> None:
     # is_archived: whether the chat is in the archive folder
     op.add_column("chats", sa.Column("is_archived", sa.Integer(), nullable=True, server_default="0"))
 
+    # Partial index for the archived chats list - only archived chats are indexed
+    op.create_index(
+        "idx_chats_archived",
+        "chats",
+        ["id"],
+        sqlite_where=sa.text("is_archived = 1"),
+        postgresql_where=sa.text("is_archived = 1"),
+    )
+
     # =========================================================================
     # STEP 2: Add reply_to_top_id to messages table
     # =========================================================================
 
     op.add_column("messages", sa.Column("reply_to_top_id", sa.BigInteger(), nullable=True))
 
-    # Index for fast topic message lookups
-    op.create_index("idx_messages_topic", "messages", ["chat_id", "reply_to_top_id"])
+    # Index for fast topic message lookups. The viewer pages a topic with
+    # WHERE chat_id = ? AND reply_to_top_id = ? ORDER BY date DESC, id DESC, so the
+    # trailing date/id columns avoid a sort. Partial: only forum messages carry a
+    # reply_to_top_id, so rows from regular chats are kept out of the index.
+    op.create_index(
+        "idx_messages_topic",
+        "messages",
+        [sa.text("chat_id"), sa.text("reply_to_top_id"), sa.text("date DESC"), sa.text("id DESC")],
+        sqlite_where=sa.text("reply_to_top_id IS NOT NULL"),
+        postgresql_where=sa.text("reply_to_top_id IS NOT NULL"),
+    )
 
     # =========================================================================
     # STEP 3: Create forum_topics table
@@ -68,6 +86,8 @@ def upgrade() -> None:
         sa.Column("created_at", sa.DateTime(), server_default=sa.func.now()),
         sa.Column("updated_at", sa.DateTime(), server_default=sa.func.now()),
         sa.PrimaryKeyConstraint("id", "chat_id"),
+        # SQLite: store rows keyed by the composite PK instead of a rowid table plus a PK index
+        sqlite_with_rowid=False,
     )
     op.create_index("idx_forum_topics_chat", "forum_topics", ["chat_id"])
 
@@ -95,15 +115,16 @@ def upgrade() -> None:
         sa.Column("folder_id", sa.Integer(), sa.ForeignKey("chat_folders.id", ondelete="CASCADE"), nullable=False),
         sa.Column("chat_id", sa.BigInteger(), sa.ForeignKey("chats.id", ondelete="CASCADE"), nullable=False),
         sa.PrimaryKeyConstraint("folder_id", "chat_id"),
+        sqlite_with_rowid=False,
     )
-    op.create_index("idx_folder_members_chat", "chat_folder_members", ["chat_id"])
-    op.create_index("idx_folder_members_folder", "chat_folder_members", ["folder_id"])
+    # Folder-side lookups use the (folder_id, chat_id) primary key; this covers
+    # the reverse "which folders contain chat X" lookup.
+    op.create_index("idx_folder_members_chat", "chat_folder_members", ["chat_id", "folder_id"])
 
 
 def downgrade() -> None:
     """Remove topics, folders, and archived chat support."""
 
-    op.drop_index("idx_folder_members_folder", table_name="chat_folder_members")
     op.drop_index("idx_folder_members_chat", table_name="chat_folder_members")
     op.drop_table("chat_folder_members")
     op.drop_table("chat_folders")
@@ -111,5 +132,6 @@ def downgrade() -> None:
     op.drop_table("forum_topics")
     op.drop_index("idx_messages_topic", table_name="messages")
     op.drop_column("messages", "reply_to_top_id")
+    op.drop_index("idx_chats_archived", table_name="chats", if_exists=True)
     op.drop_column("chats", "is_archived")
     op.drop_column("chats", "is_forum")
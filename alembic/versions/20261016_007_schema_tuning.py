@@ -0,0 +1,335 @@
+"""Index and constraint tuning for existing databases.
+
+This migration brings databases that already ran 002-006 in line with the
+index and constraint definitions those migrations now create on fresh installs:
+1. Extends idx_messages_chat_date_desc to (chat_id, date DESC, id DESC) so
+   keyset pagination (ORDER BY date DESC, id DESC) is served straight from
+   the index without a sort step; on PostgreSQL it also INCLUDEs sender_id,
+   reply_to_msg_id and is_pinned so narrow lookups become index-only scans
+   (run VACUUM (ANALYZE) messages afterwards to populate the visibility map)
+2. Turns idx_messages_chat_pinned into a partial index on chat_id
+   WHERE is_pinned = 1, since almost no messages are pinned
+3. Extends idx_messages_topic to (chat_id, reply_to_top_id, date DESC, id DESC)
+   WHERE reply_to_top_id IS NOT NULL, matching the topic pagination query
+4. Adds the partial idx_chats_archived index on chats (id) WHERE is_archived = 1
+5. Adds the push_subscriptions.chat_id -> chats.id FK with ON DELETE CASCADE
+   (orphaned chat-specific subscriptions are removed first)
+6. Drops idx_messages_chat_id, a prefix of idx_messages_chat_date_desc
+7. Turns idx_reactions_user into a partial index WHERE user_id IS NOT NULL
+8. Turns idx_chats_username/idx_users_username into partial indexes
+   WHERE username IS NOT NULL
+9. Extends idx_messages_reply_to to (chat_id, reply_to_msg_id, date DESC, id DESC)
+   WHERE reply_to_msg_id IS NOT NULL
+10. Drops idx_folder_members_folder (duplicates the (folder_id, chat_id) primary
+    key) and extends idx_folder_members_chat to (chat_id, folder_id)
+11. Adds the partial idx_media_needs_size index on media (chat_id, file_name)
+    for downloadable media with no recorded file size (scripts/update_media_sizes.py)
+12. Validates the fk_media_message/fk_reactions_user foreign keys that 005 adds
+    NOT VALID on PostgreSQL
+
+On PostgreSQL, indexes whose definition changes are built CONCURRENTLY under a
+temporary name and swapped in (_swap_index), and ones that already match are
+left alone, so messages keeps its indexes throughout and a failed run can be
+repeated.
+
+Revision ID: 007
+Revises: 006
+Create Date: 2026-10-16
+
+"""
+
+from collections.abc import Sequence
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "007"
+down_revision: str | None = "006"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    """Recreate indexes and constraints with their tuned definitions."""
+
+    conn = op.get_bind()
+    dialect = conn.dialect.name
+
+    # =========================================================================
+    # STEP 1: Keyset pagination index
+    # =========================================================================
+
+    if dialect == "postgresql":
+        _swap_index(
+            "idx_messages_chat_date_desc",
+            "messages",
+            ["chat_id", "date DESC", "id DESC"],
+            include=["sender_id", "reply_to_msg_id", "is_pinned"],
+        )
+    else:
+        op.drop_index("idx_messages_chat_date_desc", table_name="messages", if_exists=True)
+        op.create_index(
+            "idx_messages_chat_date_desc",
+            "messages",
+            [sa.text("chat_id"), sa.text("date DESC"), sa.text("id DESC")],
+        )
+
+    # =========================================================================
+    # STEP 2: Partial pinned-messages index
+    # =========================================================================
+
+    if dialect == "postgresql":
+        _swap_index("idx_messages_chat_pinned", "messages", ["chat_id"], where="is_pinned = 1")
+    else:
+        op.drop_index("idx_messages_chat_pinned", table_name="messages", if_exists=True)
+        op.create_index("idx_messages_chat_pinned", "messages", ["chat_id"], sqlite_where=sa.text("is_pinned = 1"))
+
+    # =========================================================================
+    # STEP 3: Forum topic pagination index
+    # =========================================================================
+
+    topic_columns = ["chat_id", "reply_to_top_id", "date DESC", "id DESC"]
+    if dialect == "postgresql":
+        _swap_index("idx_messages_topic", "messages", topic_columns, where="reply_to_top_id IS NOT NULL")
+    else:
+        op.drop_index("idx_messages_topic", table_name="messages", if_exists=True)
+        op.create_index(
+            "idx_messages_topic",
+            "messages",
+            [sa.text(column) for column in topic_columns],
+            sqlite_where=sa.text("reply_to_top_id IS NOT NULL"),
+        )
+
+    # =========================================================================
+    # STEP 4: Partial archived-chats index
+    # =========================================================================
+
+    op.create_index(
+        "idx_chats_archived",
+        "chats",
+        ["id"],
+        sqlite_where=sa.text("is_archived = 1"),
+        postgresql_where=sa.text("is_archived = 1"),
+        if_not_exists=True,
+    )
+
+    # =========================================================================
+    # STEP 5: Cascade push subscriptions with their chat
+    # =========================================================================
+
+    # Offline (--sql) runs cannot inspect the schema; there the FK comes from 003
+    if not op.get_context().as_sql and not any(
+        fk["referred_table"] == "chats" for fk in sa.inspect(conn).get_foreign_keys("push_subscriptions")
+    ):
+        op.execute(
+            sa.text("""
+            DELETE FROM push_subscriptions
+            WHERE chat_id IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM chats WHERE chats.id = push_subscriptions.chat_id)
+        """)
+        )
+        # batch mode rebuilds the (small) table on SQLite, plain ALTER on PostgreSQL
+        with op.batch_alter_table("push_subscriptions") as batch_op:
+            batch_op.create_foreign_key("fk_push_sub_chat", "chats", ["chat_id"], ["id"], ondelete="CASCADE")
+
+    # =========================================================================
+    # STEP 6: Drop redundant single-column index
+    # =========================================================================
+
+    if dialect == "postgresql":
+        with op.get_context().autocommit_block():
+            op.drop_index("idx_messages_chat_id", table_name="messages", postgresql_concurrently=True, if_exists=True)
+    else:
+        op.drop_index("idx_messages_chat_id", table_name="messages", if_exists=True)
+
+    # =========================================================================
+    # STEP 7: Partial reactions-by-user index
+    # =========================================================================
+
+    if dialect == "postgresql":
+        _swap_index("idx_reactions_user", "reactions", ["user_id"], where="user_id IS NOT NULL")
+    else:
+        op.drop_index("idx_reactions_user", table_name="reactions", if_exists=True)
+        op.create_index("idx_reactions_user", "reactions", ["user_id"], sqlite_where=sa.text("user_id IS NOT NULL"))
+
+    # =========================================================================
+    # STEP 8: Partial username indexes
+    # =========================================================================
+
+    for index_name, table in (("idx_chats_username", "chats"), ("idx_users_username", "users")):
+        if dialect == "postgresql":
+            _swap_index(index_name, table, ["username"], where="username IS NOT NULL")
+        else:
+            op.drop_index(index_name, table_name=table, if_exists=True)
+            op.create_index(index_name, table, ["username"], sqlite_where=sa.text("username IS NOT NULL"))
+
+    # =========================================================================
+    # STEP 9: Reply thread index
+    # =========================================================================
+
+    reply_columns = ["chat_id", "reply_to_msg_id", "date DESC", "id DESC"]
+    if dialect == "postgresql":
+        _swap_index("idx_messages_reply_to", "messages", reply_columns, where="reply_to_msg_id IS NOT NULL")
+    else:
+        op.drop_index("idx_messages_reply_to", table_name="messages", if_exists=True)
+        op.create_index(
+            "idx_messages_reply_to",
+            "messages",
+            [sa.text(column) for column in reply_columns],
+            sqlite_where=sa.text("reply_to_msg_id IS NOT NULL"),
+        )
+
+    # =========================================================================
+    # STEP 10: Folder membership indexes
+    # =========================================================================
+
+    if dialect == "postgresql":
+        with op.get_context().autocommit_block():
+            op.drop_index(
+                "idx_folder_members_folder",
+                table_name="chat_folder_members",
+                postgresql_concurrently=True,
+                if_exists=True,
+            )
+        _swap_index("idx_folder_members_chat", "chat_folder_members", ["chat_id", "folder_id"])
+    else:
+        op.drop_index("idx_folder_members_folder", table_name="chat_folder_members", if_exists=True)
+        op.drop_index("idx_folder_members_chat", table_name="chat_folder_members", if_exists=True)
+        op.create_index("idx_folder_members_chat", "chat_folder_members", ["chat_id", "folder_id"])
+
+    # =========================================================================
+    # STEP 11: Partial missing-file-size index
+    # =========================================================================
+
+    # Literal predicate, matched by the query in scripts/update_media_sizes.py
+    needs_size = sa.text(
+        "type IN ('photo', 'video', 'audio', 'voice', 'document', 'sticker', 'animation')"
+        " AND (file_size IS NULL OR file_size = 0)"
+    )
+    if dialect == "postgresql":
+        with op.get_context().autocommit_block():
+            # IF NOT EXISTS would keep an INVALID index left by an interrupted build
+            state = _index_state("idx_media_needs_size")
+            if state is not None and not state[1]:
+                op.drop_index("idx_media_needs_size", table_name="media", postgresql_concurrently=True)
+            op.create_index(
+                "idx_media_needs_size",
+                "media",
+                ["chat_id", "file_name"],
+                postgresql_where=needs_size,
+                postgresql_concurrently=True,
+                if_not_exists=True,
+            )
+    else:
+        op.create_index(
+            "idx_media_needs_size", "media", ["chat_id", "file_name"], sqlite_where=needs_size, if_not_exists=True
+        )
+
+    # =========================================================================
+    # STEP 12: Validate the 005 foreign keys
+    # =========================================================================
+
+    if dialect == "postgresql":
+        # Scan the existing rows outside the migration transaction: VALIDATE CONSTRAINT
+        # only takes SHARE UPDATE EXCLUSIVE, so reads and writes carry on. It is a no-op
+        # on constraints that are already valid, so a failed run can be repeated once
+        # the offending rows are fixed; until then the FKs still check new writes.
+        with op.get_context().autocommit_block():
+            op.execute(sa.text("ALTER TABLE media VALIDATE CONSTRAINT fk_media_message"))
+            op.execute(sa.text("ALTER TABLE reactions VALIDATE CONSTRAINT fk_reactions_user"))
+
+
+def _index_state(name: str) -> tuple[str, bool] | None:
+    """(pg_indexes.indexdef, indisvalid) of a PostgreSQL index, or None if it doesn't exist.
+
+    An index that is not valid is the leftover of an interrupted CONCURRENTLY
+    build. Offline (--sql) runs cannot inspect the schema and always get None.
+    """
+    if op.get_context().as_sql:
+        return None
+    row = (
+        op.get_bind()
+        .execute(
+            sa.text("""
+            SELECT pg_get_indexdef(indexrelid), indisvalid
+            FROM pg_index
+            WHERE indexrelid = to_regclass(:name)
+        """),
+            {"name": name},
+        )
+        .first()
+    )
+    return None if row is None else (row[0], row[1])
+
+
+def _swap_index(
+    name: str, table: str, columns: list[str], include: list[str] | None = None, where: str | None = None
+) -> None:
+    """Rebuild a PostgreSQL index with a new definition without blocking writes.
+
+    The new index is built CONCURRENTLY under a temporary name and only then
+    swapped in, so queries keep using the old one for the whole build. Nothing
+    happens if the index already has this definition (fresh installs get it
+    from 002-006), and INVALID leftovers of an interrupted run are dropped
+    first, so the step can simply be re-run.
+    """
+    # pg_indexes.indexdef for the target definition, as PostgreSQL prints it
+    definition = f"({', '.join(columns)})"
+    if include:
+        definition += f" INCLUDE ({', '.join(include)})"
+    if where:
+        definition += f" WHERE ({where})"
+
+    def matches(state: tuple[str, bool] | None) -> bool:
+        return state is not None and state[1] and state[0].endswith(f" USING btree {definition}")
+
+    tmp_name = f"{name}_new"
+    with op.get_context().autocommit_block():
+        tmp_state = _index_state(tmp_name)
+        if matches(_index_state(name)):
+            if tmp_state is not None:
+                op.drop_index(tmp_name, table_name=table, postgresql_concurrently=True)
+            return
+        if not matches(tmp_state):
+            op.drop_index(tmp_name, table_name=table, postgresql_concurrently=True, if_exists=True)
+            op.create_index(
+                tmp_name,
+                table,
+                [sa.text(column) for column in columns],
+                postgresql_include=include or [],
+                postgresql_where=sa.text(where) if where else None,
+                postgresql_concurrently=True,
+            )
+        op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
+        op.execute(sa.text(f"ALTER INDEX {tmp_name} RENAME TO {name}"))
+
+
+def downgrade() -> None:
+    """Restore the pre-007 index and constraint definitions."""
+
+    op.drop_index("idx_media_needs_size", table_name="media")
+
+    op.drop_index("idx_folder_members_chat", table_name="chat_folder_members")
+    op.create_index("idx_folder_members_chat", "chat_folder_members", ["chat_id"])
+    op.create_index("idx_folder_members_folder", "chat_folder_members", ["folder_id"])
+
+    op.drop_index("idx_messages_reply_to", table_name="messages")
+    op.create_index("idx_messages_reply_to", "messages", ["chat_id", "reply_to_msg_id"])
+
+    for index_name, table in (("idx_chats_username", "chats"), ("idx_users_username", "users")):
+        op.drop_index(index_name, table_name=table)
+        op.create_index(index_name, table, ["username"])
+    op.drop_index("idx_reactions_user", table_name="reactions")
+    op.create_index("idx_reactions_user", "reactions", ["user_id"])
+    op.drop_index("idx_messages_topic", table_name="messages")
+    op.create_index("idx_messages_topic", "messages", ["chat_id", "reply_to_top_id"])
+    # idx_chats_archived and the push_subscriptions FK are left in place, and
+    # idx_messages_chat_id is not recreated: fresh installs get the same state
+    # from migrations 003/005/006, whose downgrades undo it.
+    op.drop_index("idx_messages_chat_pinned", table_name="messages")
+    op.create_index("idx_messages_chat_pinned", "messages", ["chat_id", "is_pinned"])
+
+    op.drop_index("idx_messages_chat_date_desc", table_name="messages")
+    op.create_index("idx_messages_chat_date_desc", "messages", ["chat_id", sa.text("date DESC")])
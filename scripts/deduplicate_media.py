@@ -17,40 +17,148 @@ Usage:
 
     # Show verbose output
     python -m scripts.deduplicate_media --verbose
+
+    # Verify duplicates by full-file hash (slower, reads every byte)
+    python -m scripts.deduplicate_media --paranoid
+
+    # Link chat copies to _shared with hardlinks instead of symlinks
+    python -m scripts.deduplicate_media --use-hardlinks
 """
 
 import argparse
+import errno
 import hashlib
 import logging
+import mmap
 import os
+import sqlite3
 import sys
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from operator import itemgetter
 
 # Add parent directory to path for imports
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from src.config import Config
 
+try:
+    # Optional: pip install blake3 (SIMD + multi-threaded hashing)
+    import blake3
+except ImportError:
+    blake3 = None
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
+# Files larger than this are hashed through mmap rather than chunked reads
+MMAP_THRESHOLD = 16 * 1024 * 1024
+
+# Bytes compared at each end of a file by _quick_match
+QUICK_MATCH_BLOCK = 64 * 1024
+
+# link() failures meaning "this filesystem can't hard-link" (exFAT, SMB/FUSE mounts, ...)
+_NO_HARDLINK_ERRNOS = frozenset({errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EXDEV, errno.ENOSYS})
 
-def get_file_hash(filepath: str, chunk_size: int = 8192) -> str:
-    """Get MD5 hash of a file for content comparison."""
-    hash_md5 = hashlib.md5()
-    with open(filepath, "rb") as f:
-        for chunk in iter(lambda: f.read(chunk_size), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
 
+def get_file_hash(filepath: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Get a content hash of a file for comparison.
+
+    Only used to check that two local copies are identical, so no cryptographic
+    strength is needed. Uses BLAKE3 when the blake3 package is installed,
+    otherwise the stdlib BLAKE2b, which is faster than MD5 on 64-bit CPUs.
+    """
+    if blake3 is not None:
+        h = blake3.blake3(max_threads=blake3.blake3.AUTO)
+        h.update_mmap(filepath)
+        return h.hexdigest()
+
+    h = hashlib.blake2b()
+    # Unbuffered: readinto() goes straight to the OS without re-buffering
+    with open(filepath, "rb", buffering=0) as f:
+        if os.fstat(f.fileno()).st_size > MMAP_THRESHOLD:
+            # Hash the mapping in one call instead of looping in Python
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
+        else:
+            # Reuse one buffer instead of allocating a bytes object per chunk
+            buf = memoryview(bytearray(chunk_size))
+            while n := f.readinto(buf):
+                h.update(buf[:n])
+    return h.hexdigest()
 
-def deduplicate_media(dry_run: bool = False, verbose: bool = False):
+
+def _quick_match(path_a: str, path_b: str, size_a: int | None = None, size_b: int | None = None) -> bool:
+    """
+    Cheap content check: same size, same first and last QUICK_MATCH_BLOCK bytes.
+
+    Files are named after Telegram's file_id, so same-named files are the same
+    media; this only guards against truncated or corrupted copies without
+    reading whole videos.
+    """
+    if size_a is None:
+        size_a = os.stat(path_a).st_size
+    if size_b is None:
+        size_b = os.stat(path_b).st_size
+    if size_b != size_a:
+        return False
+
+    tail_offset = max(0, size_a - QUICK_MATCH_BLOCK)
+    fd_a = os.open(path_a, os.O_RDONLY)
+    try:
+        fd_b = os.open(path_b, os.O_RDONLY)
+        try:
+            if os.pread(fd_a, QUICK_MATCH_BLOCK, 0) != os.pread(fd_b, QUICK_MATCH_BLOCK, 0):
+                return False
+            return os.pread(fd_a, QUICK_MATCH_BLOCK, tail_offset) == os.pread(fd_b, QUICK_MATCH_BLOCK, tail_offset)
+        finally:
+            os.close(fd_b)
+    finally:
+        os.close(fd_a)
+
+
+def _scan_chat_dir(chat_dir: str, chat_idx: int):
+    """Yield (name, chat_idx, size, dev, ino) for each regular file in chat_dir."""
+    for file_entry in os.scandir(chat_dir):
+        # DirEntry caches the file type and lstat result, so this costs at most
+        # one lstat per file. Symlinks (already deduplicated) are excluded by
+        # follow_symlinks=False.
+        if file_entry.is_file(follow_symlinks=False):
+            st = file_entry.stat(follow_symlinks=False)
+            yield file_entry.name, chat_idx, st.st_size, st.st_dev, st.st_ino
+
+
+def _replace_with_link(shared_path: str, file_path: str, hardlink: bool = False):
+    """
+    Atomically replace file_path with a link to shared_path.
+
+    The link is created under a temporary name and renamed over file_path, so
+    a crash at any point leaves either the original file or the link.
+    """
+    tmp_path = os.path.join(os.path.dirname(file_path), f".{os.path.basename(file_path)}.dedup-tmp")
+    if hardlink:
+        os.link(shared_path, tmp_path)
+    else:
+        os.symlink(os.path.relpath(shared_path, os.path.dirname(file_path)), tmp_path)
+    try:
+        os.replace(tmp_path, file_path)
+    except OSError:
+        os.unlink(tmp_path)
+        raise
+
+
+def deduplicate_media(
+    dry_run: bool = False, verbose: bool = False, paranoid: bool = False, use_hardlinks: bool = False
+):
     """
-    Deduplicate media files using symlinks.
+    Deduplicate media files using symlinks (or hardlinks).
 
     Args:
         dry_run: If True, only report what would be done
         verbose: If True, show detailed output
+        paranoid: If True, compare full-file hashes instead of size + head/tail blocks
+        use_hardlinks: If True, link chat copies to _shared with hardlinks instead of symlinks
     """
     config = Config()
     media_base_path = config.media_path
@@ -61,15 +169,22 @@ def deduplicate_media(dry_run: bool = False, verbose: bool = False):
 
     logger.info(f"Media path: {media_base_path}")
     logger.info(f"Dry run: {dry_run}")
+    logger.info(f"Link type: {'hardlinks' if use_hardlinks else 'symlinks'}")
 
     # Create shared directory
     shared_dir = os.path.join(media_base_path, "_shared")
     if not dry_run:
         os.makedirs(shared_dir, exist_ok=True)
 
-    # Scan all chat directories and group files by name
+    # Scan all chat directories and index files by name in a throwaway on-disk
+    # SQLite database, so memory stays flat on archives with millions of files.
     # Files with same name (based on telegram_file_id) are candidates for dedup
-    files_by_name = defaultdict(list)
+    index = sqlite3.connect("")  # "" = private temporary database, deleted on close
+    index.execute(
+        "CREATE TABLE files (name TEXT NOT NULL, chat_dir INTEGER NOT NULL, "
+        "size INTEGER NOT NULL, dev INTEGER NOT NULL, ino INTEGER NOT NULL)"
+    )
+    chat_dirs = []
 
     logger.info("Scanning media directories...")
 
@@ -77,22 +192,33 @@ def deduplicate_media(dry_run: bool = False, verbose: bool = False):
         if not entry.is_dir() or entry.name.startswith("_"):
             continue
 
-        chat_dir = entry.path
-        for file_entry in os.scandir(chat_dir):
-            if file_entry.is_file() and not file_entry.is_symlink():
-                files_by_name[file_entry.name].append(file_entry.path)
+        chat_idx = len(chat_dirs)
+        chat_dirs.append(entry.path)
+        # Record size and identity now instead of re-statting every file later
+        index.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?)", _scan_chat_dir(entry.path, chat_idx))
 
+    # Build the index after loading, then group by name from it
+    index.execute("CREATE INDEX idx_files_name ON files (name)")
+
+    total_files, unique_names = index.execute("SELECT COUNT(*), COUNT(DISTINCT name) FROM files").fetchone()
     # Find duplicates (files with same name appearing in multiple directories)
-    duplicates = {name: paths for name, paths in files_by_name.items() if len(paths) > 1}
+    duplicate_names, total_duplicates = index.execute(
+        "SELECT COUNT(*), COALESCE(SUM(n - 1), 0) FROM (SELECT COUNT(*) AS n FROM files GROUP BY name HAVING n > 1)"
+    ).fetchone()
 
-    logger.info(f"Found {len(files_by_name)} unique file names")
-    logger.info(f"Found {len(duplicates)} file names with duplicates")
+    logger.info(f"Found {unique_names} unique file names")
+    logger.info(f"Found {duplicate_names} file names with duplicates")
 
     # Also include single files for future dedup (move to shared)
-    all_files_to_process = files_by_name
-
-    total_files = sum(len(paths) for paths in all_files_to_process.values())
-    total_duplicates = sum(len(paths) - 1 for paths in duplicates.values())
+    all_files_to_process = (
+        (
+            filename,
+            [(os.path.join(chat_dirs[chat_idx], filename), size, (dev, ino)) for _, chat_idx, size, dev, ino in rows],
+        )
+        for filename, rows in groupby(
+            index.execute("SELECT name, chat_dir, size, dev, ino FROM files ORDER BY name, rowid"), key=itemgetter(0)
+        )
+    )
 
     logger.info(f"Total files to process: {total_files}")
     logger.info(f"Total duplicate files: {total_duplicates}")
@@ -101,95 +227,127 @@ def deduplicate_media(dry_run: bool = False, verbose: bool = False):
     space_saved = 0
     files_deduplicated = 0
     files_moved_to_shared = 0
-    symlinks_created = 0
+    links_created = 0
     errors = 0
 
-    for filename, file_paths in all_files_to_process.items():
+    # Duplicates to replace with links: (filename, shared_path, file_path, source_size)
+    pending = []
+
+    for filename, file_entries in all_files_to_process:
         shared_path = os.path.join(shared_dir, filename)
 
         # Check if already in shared
-        if os.path.exists(shared_path):
-            # File already in shared, just need to create symlinks
+        try:
+            # File already in shared, just need to create links
+            shared_stat = os.stat(shared_path)
+            source_size = shared_stat.st_size
+            shared_id = (shared_stat.st_dev, shared_stat.st_ino)
             source_path = shared_path
             source_existed = True
-        else:
+        except FileNotFoundError:
             # Use first file as source
-            source_path = file_paths[0]
+            source_path, source_size, _ = file_entries[0]
+            shared_id = None
             source_existed = False
-
-        try:
-            source_size = os.path.getsize(source_path)
         except OSError:
             errors += 1
             continue
 
-        for file_path in file_paths:
-            chat_dir = os.path.dirname(file_path)
-
-            # Skip if this is already a symlink
-            if os.path.islink(file_path):
+        for file_path, size, file_id in file_entries:
+            # Skip copies that are already hardlinks to the shared file
+            if file_id == shared_id:
                 continue
 
             # Skip if this is the source file and we haven't moved it yet
             if file_path == source_path and not source_existed:
-                # Move source to shared
+                # Move source to shared by hard-linking it into _shared, so the file
+                # is always in at least one of the two places. Symlink mode then
+                # swaps the chat copy for a symlink atomically. Filesystems without
+                # hard links fall back to rename() then symlink().
                 if not dry_run:
                     try:
-                        os.rename(source_path, shared_path)
-                        # Create symlink in original location
-                        rel_path = os.path.relpath(shared_path, chat_dir)
-                        os.symlink(rel_path, file_path)
+                        try:
+                            os.link(source_path, shared_path)
+                        except OSError as e:
+                            if use_hardlinks or e.errno not in _NO_HARDLINK_ERRNOS:
+                                raise
+                            os.rename(source_path, shared_path)
+                            os.symlink(os.path.relpath(shared_path, os.path.dirname(file_path)), file_path)
+                        else:
+                            if not use_hardlinks:
+                                _replace_with_link(shared_path, file_path)
                         files_moved_to_shared += 1
-                        symlinks_created += 1
+                        links_created += 1
                     except OSError as e:
                         logger.error(f"Error moving {source_path}: {e}")
                         errors += 1
                 else:
                     files_moved_to_shared += 1
-                    symlinks_created += 1
+                    links_created += 1
                 continue
 
-            # This is a duplicate - remove and create symlink
-            if verbose:
-                logger.info(f"Deduplicating: {file_path} -> {shared_path}")
+            # This is a duplicate - replace it with a link. Different sizes can't
+            # match, and the scan already has both, so skip without opening either.
+            if size != source_size:
+                logger.warning(f"Size mismatch for {file_path}, skipping")
+                continue
+
+            if dry_run:
+                if verbose:
+                    logger.info(f"Deduplicating: {file_path} -> {shared_path}")
+                files_deduplicated += 1
+                links_created += 1
+                space_saved += source_size
+            elif os.path.exists(shared_path):
+                pending.append((filename, shared_path, file_path, source_size))
 
-            if not dry_run:
-                try:
-                    # Verify content matches before deleting
-                    if os.path.exists(shared_path):
-                        source_hash = get_file_hash(shared_path)
-                        dup_hash = get_file_hash(file_path)
+    index.close()
 
-                        if source_hash != dup_hash:
-                            logger.warning(f"Hash mismatch for {filename}, skipping")
-                            continue
+    # Verify content in parallel (hashing releases the GIL, and the reads
+    # overlap on SSD/NVMe), then apply the filesystem changes serially.
+    def verify(job):
+        filename, shared_path, file_path, source_size = job
+        # Sizes were already compared against the scan, so skip both stats
+        if not _quick_match(shared_path, file_path, source_size, source_size):
+            return f"Content mismatch for {filename}, skipping"
+        if paranoid and get_file_hash(shared_path) != get_file_hash(file_path):
+            return f"Hash mismatch for {filename}, skipping"
+        return None
 
-                    # Remove duplicate
-                    os.remove(file_path)
+    if pending:
+        logger.info(f"Verifying {len(pending)} duplicates...")
 
-                    # Create symlink
-                    rel_path = os.path.relpath(shared_path, chat_dir)
-                    os.symlink(rel_path, file_path)
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+        futures = [executor.submit(verify, job) for job in pending]
 
-                    files_deduplicated += 1
-                    symlinks_created += 1
-                    space_saved += source_size
+        for (filename, shared_path, file_path, source_size), future in zip(pending, futures):
+            try:
+                mismatch = future.result()
+                if mismatch:
+                    logger.warning(mismatch)
+                    continue
+
+                if verbose:
+                    logger.info(f"Deduplicating: {file_path} -> {shared_path}")
+
+                # Swap the duplicate for a link
+                _replace_with_link(shared_path, file_path, hardlink=use_hardlinks)
 
-                except OSError as e:
-                    logger.error(f"Error deduplicating {file_path}: {e}")
-                    errors += 1
-            else:
                 files_deduplicated += 1
-                symlinks_created += 1
+                links_created += 1
                 space_saved += source_size
 
+            except OSError as e:
+                logger.error(f"Error deduplicating {file_path}: {e}")
+                errors += 1
+
     # Summary
     logger.info("=" * 60)
     logger.info("SUMMARY")
     logger.info("=" * 60)
     logger.info(f"Files moved to _shared: {files_moved_to_shared}")
     logger.info(f"Duplicate files removed: {files_deduplicated}")
-    logger.info(f"Symlinks created: {symlinks_created}")
+    logger.info(f"{'Hardlinks' if use_hardlinks else 'Symlinks'} created: {links_created}")
     logger.info(f"Space saved: {space_saved / (1024 * 1024 * 1024):.2f} GB")
     logger.info(f"Errors: {errors}")
 
@@ -202,10 +360,19 @@ def main():
     parser = argparse.ArgumentParser(description="Deduplicate media files using symlinks")
     parser.add_argument("--dry-run", action="store_true", help="Show what would be done without making changes")
     parser.add_argument("--verbose", "-v", action="store_true", help="Show detailed output")
+    parser.add_argument(
+        "--paranoid", action="store_true", help="Verify duplicates by full-file hash instead of size + head/tail"
+    )
+
+    parser.add_argument(
+        "--use-hardlinks", action="store_true", help="Link chat copies to _shared with hardlinks instead of symlinks"
+    )
 
     args = parser.parse_args()
 
-    deduplicate_media(dry_run=args.dry_run, verbose=args.verbose)
+    deduplicate_media(
+        dry_run=args.dry_run, verbose=args.verbose, paranoid=args.paranoid, use_hardlinks=args.use_hardlinks
+    )
 
 
 if __name__ == "__main__":
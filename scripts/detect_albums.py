@@ -17,20 +17,29 @@ Usage:
 
     # Adjust time window (default: 2 seconds)
     python -m scripts.detect_albums --window 3
+
+    # Commit every 10 update batches (10,000 rows) instead of every batch
+    python -m scripts.detect_albums --commit-every 10
 """
 
 import argparse
 import asyncio
-import json
 import logging
 import os
 import sys
-from collections import defaultdict
+from datetime import datetime
 
 # Add parent directory to path for imports
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+try:
+    # Optional: pip install numpy (vectorized album boundary detection)
+    import numpy as np
+except ImportError:
+    np = None
 
 from src.config import Config
 from src.db import create_adapter
@@ -38,50 +47,159 @@ from src.db import create_adapter
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
+# Rows per UPDATE executemany
+BATCH_SIZE = 1000
+
+# Rows fetched per round trip while streaming the photo/video scan
+SCAN_YIELD_PER = 10_000
+
+_EPOCH = datetime(1970, 1, 1)
+_NO_SENDER = -(2**63)  # stands in for sender_id None in the int64 sender array
+
+
+# Statements patching grouped_id/album_detected into raw_data, built once per
+# dialect. Missing raw_data or invalid JSON becomes an object with just those
+# two keys (on PostgreSQL via _SET_GROUPED_ID_POSTGRESQL_RESET, see _bulk_set_grouped_id).
+_SET_GROUPED_ID_POSTGRESQL = text("""
+    UPDATE messages
+    SET raw_data = (
+        COALESCE(NULLIF(raw_data, ''), '{}')::jsonb
+        || jsonb_build_object('grouped_id', CAST(:grouped_id AS bigint), 'album_detected', true)
+    )::text
+    WHERE chat_id = :chat_id AND id = :id
+""")
+_SET_GROUPED_ID_POSTGRESQL_RESET = text("""
+    UPDATE messages
+    SET raw_data = jsonb_build_object('grouped_id', CAST(:grouped_id AS bigint), 'album_detected', true)::text
+    WHERE chat_id = :chat_id AND id = :id
+""")
+_SET_GROUPED_ID_SQLITE = text("""
+    UPDATE messages
+    SET raw_data = json_set(
+        CASE WHEN json_valid(raw_data) THEN raw_data ELSE '{}' END,
+        '$.grouped_id', :grouped_id,
+        '$.album_detected', json('true')
+    )
+    WHERE chat_id = :chat_id AND id = :id
+""")
+
+
+def _is_invalid_json_error(e: DBAPIError) -> bool:
+    """Whether a PostgreSQL error is a data exception (SQLSTATE class 22), e.g. a failed ::jsonb cast."""
+    return str(getattr(e.orig, "sqlstate", None) or "").startswith("22")
 
-async def _bulk_update_raw_data(session, updates: list):
+
+async def _bulk_set_grouped_id(session, query, updates: list, reset_query=None):
     """
-    Bulk update raw_data for messages using a single SQL query.
+    Set grouped_id/album_detected in raw_data for messages, patching the JSON in the database.
+
+    Only the ids travel; raw_data is never fetched, parsed or re-serialized in Python.
 
     Args:
         session: SQLAlchemy async session
-        updates: List of (chat_id, message_id, raw_data_json_str) tuples
+        query: _SET_GROUPED_ID_POSTGRESQL or _SET_GROUPED_ID_SQLITE
+        updates: List of (chat_id, message_id, grouped_id) tuples
+        reset_query: Statement for rows whose raw_data is not valid JSON
+            (_SET_GROUPED_ID_POSTGRESQL_RESET), or None when query guards itself
     """
     if not updates:
         return
 
-    dialect = session.bind.dialect.name
+    params = [{"chat_id": chat_id, "id": msg_id, "grouped_id": grouped_id} for chat_id, msg_id, grouped_id in updates]
+    if reset_query is None:
+        # One prepared statement, bound per row (executemany)
+        await session.execute(query, params)
+        return
+
+    # A single raw_data that isn't valid JSON fails the ::jsonb cast and with it the
+    # whole executemany. Run the batch in a savepoint; if that happens, redo it row
+    # by row and reset only the bad rows.
+    try:
+        async with session.begin_nested():
+            await session.execute(query, params)
+    except DBAPIError as e:
+        if not _is_invalid_json_error(e):
+            raise
+        for row in params:
+            try:
+                async with session.begin_nested():
+                    await session.execute(query, row)
+            except DBAPIError as e:
+                if not _is_invalid_json_error(e):
+                    raise
+                await session.execute(reset_query, row)
+
+
+async def _chat_runs(result):
+    """
+    Yield (chat_id, rows) for each chat of a streamed result ordered by chat_id.
+
+    Only one chat's rows are held at a time.
+    """
+    chat_id, chat_messages = None, []
+    async for partition in result.partitions():
+        for row in partition:
+            if row.chat_id != chat_id:
+                if chat_messages:
+                    yield chat_id, chat_messages
+                chat_id, chat_messages = row.chat_id, []
+            chat_messages.append(row)
+    if chat_messages:
+        yield chat_id, chat_messages
+
+
+def _album_runs(messages: list, window_seconds: int) -> list[tuple[int, int]]:
+    """
+    Find albums in one chat's date-ordered messages.
+
+    Consecutive messages join while they share a sender and are at most
+    window_seconds apart. Messages that already have a grouped_id (or no date)
+    never join, so they also end the run before them.
+
+    Returns:
+        (start, end) slice bounds of every run of 2+ messages
+    """
+    n = len(messages)
 
-    if dialect == "postgresql":
-        # PostgreSQL - UPDATE FROM VALUES
-        # Escape single quotes in JSON strings
-        values_str = ", ".join(
-            f"({chat_id}::bigint, {msg_id}::bigint, '{raw_data.replace(chr(39), chr(39) + chr(39))}'::text)"
-            for chat_id, msg_id, raw_data in updates
+    if np is not None:
+        dates = np.fromiter(
+            ((msg.date - _EPOCH).total_seconds() if msg.date else np.nan for msg in messages), dtype=np.float64, count=n
         )
-        query = text(f"""
-            UPDATE messages
-            SET raw_data = v.raw_data
-            FROM (VALUES {values_str}) AS v(chat_id, id, raw_data)
-            WHERE messages.chat_id = v.chat_id AND messages.id = v.id
-        """)
-    else:
-        # SQLite - multiple CASE WHEN
-        case_clauses = " ".join(
-            f"WHEN chat_id = {chat_id} AND id = {msg_id} THEN '{raw_data.replace(chr(39), chr(39) + chr(39))}'"
-            for chat_id, msg_id, raw_data in updates
+        senders = np.fromiter(
+            (_NO_SENDER if msg.sender_id is None else msg.sender_id for msg in messages), dtype=np.int64, count=n
         )
-        where_clauses = " OR ".join(f"(chat_id = {chat_id} AND id = {msg_id})" for chat_id, msg_id, _ in updates)
-        query = text(f"""
-            UPDATE messages
-            SET raw_data = CASE {case_clauses} END
-            WHERE {where_clauses}
-        """)
-
-    await session.execute(query)
+        grouped = np.fromiter((bool(msg.already_grouped) for msg in messages), dtype=np.bool_, count=n)
+
+        # NaN (missing date) compares False, so it breaks the run
+        joins = (np.abs(np.diff(dates)) <= window_seconds) & (senders[1:] == senders[:-1])
+        joins &= ~grouped[1:] & ~grouped[:-1]
+
+        starts = np.concatenate(([0], np.flatnonzero(~joins) + 1))
+        ends = np.append(starts[1:], n)
+        albums = np.flatnonzero(ends - starts >= 2)
+        return list(zip(starts[albums].tolist(), ends[albums].tolist()))
+
+    runs = []
+    start = 0
+    for i in range(1, n + 1):
+        if i < n:
+            prev, msg = messages[i - 1], messages[i]
+            if (
+                not prev.already_grouped
+                and not msg.already_grouped
+                and msg.sender_id == prev.sender_id
+                and msg.date
+                and prev.date
+                and abs((msg.date - prev.date).total_seconds()) <= window_seconds
+            ):
+                continue
+        if i - start >= 2:
+            runs.append((start, i))
+        start = i
+    return runs
 
 
-async def detect_albums(dry_run: bool = False, window_seconds: int = 2):
+async def detect_albums(dry_run: bool = False, window_seconds: int = 2, commit_every: int = 1):
     """
     Detect albums by grouping consecutive photos/videos from the same sender
     that were sent within a short time window.
@@ -89,6 +207,7 @@ async def detect_albums(dry_run: bool = False, window_seconds: int = 2):
     Args:
         dry_run: If True, only report what would be done
         window_seconds: Maximum seconds between messages to consider them part of same album
+        commit_every: Number of BATCH_SIZE update batches per transaction
     """
     config = Config()
     db = await create_adapter()
@@ -101,135 +220,135 @@ async def detect_albums(dry_run: bool = False, window_seconds: int = 2):
     logger.info("")
 
     async with db.db_manager.async_session_factory() as session:
-        from sqlalchemy import and_, select
+        from sqlalchemy import and_, case, literal_column, select
 
         from src.db.models import Media, Message
 
-        # Get all photo/video messages that don't have grouped_id, ordered by chat and date
-        # v6.0.0: Join with Media table to get media type
-        logger.info("Fetching photo/video messages without grouped_id...")
+        # Resolve the dialect once; the UPDATE statement is reused for every batch
+        dialect = session.bind.dialect.name
+        if dialect == "postgresql":
+            set_grouped_id, reset_grouped_id = _SET_GROUPED_ID_POSTGRESQL, _SET_GROUPED_ID_POSTGRESQL_RESET
+        else:
+            set_grouped_id, reset_grouped_id = _SET_GROUPED_ID_SQLITE, None
+
+        # Decide "already grouped" in SQL so raw_data never has to be fetched.
+        # Those rows are still returned: an existing album ends any album being
+        # detected around it.
+        if dialect == "postgresql":
+            # Matched on the text, without a ::jsonb cast: one malformed raw_data would
+            # otherwise fail the whole SELECT. grouped_id is stored as a number or a
+            # numeric string, so the regex also skips "grouped_id": null.
+            has_grouped_id = literal_column(
+                "(messages.raw_data LIKE '%\"grouped_id\"%' "
+                "AND messages.raw_data ~ '\"grouped_id\"\\s*:\\s*\"?-?[0-9]')"
+            )
+        else:
+            # CASE (not AND) so json_extract never sees malformed JSON
+            has_grouped_id = literal_column(
+                "CASE WHEN json_valid(messages.raw_data) "
+                "THEN json_extract(messages.raw_data, '$.grouped_id') IS NOT NULL ELSE 0 END"
+            )
 
-        result = await session.execute(
-            select(Message)
+        # Stream all photo/video messages, ordered by chat and date, and analyze each
+        # chat as its rows arrive. v6.0.0: Join with Media table to get media type
+        logger.info("Scanning photo/video messages...")
+
+        # Only the columns album detection needs, as lightweight rows rather than ORM objects.
+        # The read transaction stays open for the whole scan; updates go through a
+        # separate write session (WAL lets it commit alongside the open read on SQLite).
+        result = await session.stream(
+            select(
+                Message.chat_id,
+                Message.id,
+                Message.date,
+                Message.sender_id,
+                has_grouped_id.label("already_grouped"),
+            )
             .join(Media, and_(Media.message_id == Message.id, Media.chat_id == Message.chat_id))
             .where(
                 Media.type.in_(["photo", "video"]),
             )
             .order_by(Message.chat_id, Message.date, Message.id)
+            .execution_options(yield_per=SCAN_YIELD_PER)
         )
-        messages = result.scalars().all()
-
-        logger.info(f"Found {len(messages)} photo/video messages to analyze")
-
-        # Group by chat
-        by_chat = defaultdict(list)
-        for msg in messages:
-            by_chat[msg.chat_id].append(msg)
-
-        logger.info(f"Spread across {len(by_chat)} chats")
-        logger.info("")
 
+        messages_scanned = 0
+        chats_scanned = 0
         albums_detected = 0
         messages_grouped = 0
         already_grouped = 0
-        pending_updates = []  # Collect all updates for bulk execution
-        BATCH_SIZE = 1000
-
-        for chat_idx, (chat_id, chat_messages) in enumerate(by_chat.items()):
-            # Progress report every 100 chats
-            if chat_idx % 100 == 0 and chat_idx > 0:
-                logger.info(f"Progress: {chat_idx}/{len(by_chat)} chats, {albums_detected} albums found")
-                # Flush pending updates
-                if pending_updates and not dry_run:
-                    await _bulk_update_raw_data(session, pending_updates)
-                    await session.commit()
-                    pending_updates = []
-
-            # Skip chats with only 1 message
-            if len(chat_messages) < 2:
-                continue
-
-            # Detect albums within this chat
-            current_album = []
-
-            for i, msg in enumerate(chat_messages):
-                # Parse existing raw_data
-                try:
-                    raw_data = json.loads(msg.raw_data) if msg.raw_data else {}
-                except:
-                    raw_data = {}
-
-                # Skip if already has grouped_id
-                if raw_data.get("grouped_id"):
-                    already_grouped += 1
-                    # Finish current album if any
-                    if len(current_album) >= 2:
-                        albums_detected += 1
-                        messages_grouped += len(current_album)
-                    current_album = []
+        pending_updates = []  # Collect updates, flushed in BATCH_SIZE chunks
+        rows_written = 0
+
+        # Batches are handed to a writer task through a small bounded queue, so
+        # the next chats are scanned while the previous batch is being written.
+        write_queue = asyncio.Queue(maxsize=4)
+
+        async def writer():
+            nonlocal rows_written
+            async with db.db_manager.async_session_factory() as write_session:
+                uncommitted_batches = 0
+                while (rows := await write_queue.get()) is not None:
+                    await _bulk_set_grouped_id(write_session, set_grouped_id, rows, reset_grouped_id)
+                    rows_written += len(rows)
+                    uncommitted_batches += 1
+                    if uncommitted_batches >= commit_every:
+                        await write_session.commit()
+                        uncommitted_batches = 0
+                if uncommitted_batches:
+                    await write_session.commit()
+
+        # If the writer fails, the TaskGroup cancels the scan and re-raises
+        async with asyncio.TaskGroup() as tg:
+            if not dry_run:
+                tg.create_task(writer())
+
+            async for chat_id, chat_messages in _chat_runs(result):
+                # Progress report every 100 chats
+                if chats_scanned % 100 == 0 and chats_scanned > 0:
+                    logger.info(f"Progress: {chats_scanned} chats, {albums_detected} albums found")
+                chats_scanned += 1
+                messages_scanned += len(chat_messages)
+
+                # Skip chats with only 1 message
+                if len(chat_messages) < 2:
                     continue
 
-                # Check if this message continues the current album
-                if current_album:
-                    last_msg = current_album[-1]
-                    time_diff = (msg.date - last_msg.date).total_seconds() if msg.date and last_msg.date else 999
-                    same_sender = msg.sender_id == last_msg.sender_id
-
-                    if same_sender and abs(time_diff) <= window_seconds:
-                        # Continue album
-                        current_album.append(msg)
-                    else:
-                        # End current album, start new potential album
-                        if len(current_album) >= 2:
-                            # This was an album - collect updates
-                            grouped_id = current_album[0].id  # Use first message ID as group ID
-
-                            for album_msg in current_album:
-                                try:
-                                    existing_raw = json.loads(album_msg.raw_data) if album_msg.raw_data else {}
-                                except:
-                                    existing_raw = {}
-                                existing_raw["grouped_id"] = grouped_id
-                                existing_raw["album_detected"] = True
-                                pending_updates.append((album_msg.chat_id, album_msg.id, json.dumps(existing_raw)))
-
-                            albums_detected += 1
-                            messages_grouped += len(current_album)
-
-                            if albums_detected <= 10:
-                                logger.info(
-                                    f"  Album detected: {len(current_album)} items in chat {chat_id} (msg {grouped_id})"
-                                )
-
-                        # Start new potential album
-                        current_album = [msg]
-                else:
-                    # Start new potential album
-                    current_album = [msg]
-
-            # Handle last album in chat
-            if len(current_album) >= 2:
-                grouped_id = current_album[0].id
-
-                for album_msg in current_album:
-                    try:
-                        existing_raw = json.loads(album_msg.raw_data) if album_msg.raw_data else {}
-                    except:
-                        existing_raw = {}
-                    existing_raw["grouped_id"] = grouped_id
-                    existing_raw["album_detected"] = True
-                    pending_updates.append((album_msg.chat_id, album_msg.id, json.dumps(existing_raw)))
-
-                albums_detected += 1
-                messages_grouped += len(current_album)
-
-                if albums_detected <= 10:
-                    logger.info(f"  Album detected: {len(current_album)} items in chat {chat_id} (msg {grouped_id})")
-
-        # Flush remaining updates
-        if pending_updates and not dry_run:
-            await _bulk_update_raw_data(session, pending_updates)
-            await session.commit()
+                already_grouped += sum(1 for msg in chat_messages if msg.already_grouped)
+
+                # Detect albums within this chat
+                for start, end in _album_runs(chat_messages, window_seconds):
+                    grouped_id = chat_messages[start].id  # Use first message ID as group ID
+
+                    for album_msg in chat_messages[start:end]:
+                        pending_updates.append((album_msg.chat_id, album_msg.id, grouped_id))
+
+                    albums_detected += 1
+                    messages_grouped += end - start
+
+                    if albums_detected <= 10:
+                        logger.info(f"  Album detected: {end - start} items in chat {chat_id} (msg {grouped_id})")
+
+                # Flush by row count so one huge chat can't build up an unbounded batch
+                while len(pending_updates) >= BATCH_SIZE:
+                    if not dry_run:
+                        await write_queue.put(pending_updates[:BATCH_SIZE])
+                        # Yield so the writer can start on the batch while we keep scanning
+                        await asyncio.sleep(0)
+                    del pending_updates[:BATCH_SIZE]
+
+            # Flush remaining updates and stop the writer
+            if not dry_run:
+                if pending_updates:
+                    await write_queue.put(pending_updates)
+                await write_queue.put(None)
+
+        # End the read transaction
+        await session.commit()
+
+        logger.info(f"Analyzed {messages_scanned} photo/video messages across {chats_scanned} chats")
+
+        if rows_written:
             logger.info("")
             logger.info("✅ Database changes committed")
 
@@ -258,10 +377,16 @@ def main():
         default=2,
         help="Maximum seconds between messages to consider them part of same album (default: 2)",
     )
+    parser.add_argument(
+        "--commit-every",
+        type=int,
+        default=1,
+        help=f"Number of {BATCH_SIZE}-row update batches per commit (default: 1)",
+    )
 
     args = parser.parse_args()
 
-    asyncio.run(detect_albums(dry_run=args.dry_run, window_seconds=args.window))
+    asyncio.run(detect_albums(dry_run=args.dry_run, window_seconds=args.window, commit_every=args.commit_every))
 
 
 if __name__ == "__main__":
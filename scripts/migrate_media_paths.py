@@ -32,11 +32,12 @@ BACKUP FIRST!
 
 import argparse
 import asyncio
+import errno
 import logging
 import os
-import re
 import shutil
 import sys
+from collections.abc import AsyncIterator
 from pathlib import Path
 
 # Add src to path for imports
@@ -49,72 +50,199 @@ from sqlalchemy.orm import sessionmaker
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
-
-async def get_group_channel_chats(session) -> list:
-    """Get all chats that are groups/channels/supergroups (have negative IDs)."""
-    result = await session.execute(text("SELECT id, type, title FROM chats WHERE id < 0 ORDER BY id"))
-    return [{"id": row[0], "type": row[1], "title": row[2]} for row in result.fetchall()]
-
-
-async def count_paths_for_chat(session, chat_id: int, old_folder: str) -> dict:
-    """Count media paths that use the old (positive) folder name in both tables."""
-    pattern = f"%/media/{old_folder}/%"
-
-    # Count in messages table
-    msg_result = await session.execute(
-        text("SELECT COUNT(*) FROM messages WHERE chat_id = :chat_id AND media_path LIKE :pattern"),
-        {"chat_id": chat_id, "pattern": pattern},
-    )
-    msg_count = msg_result.scalar() or 0
-
-    # Count in media table
-    media_result = await session.execute(
-        text("SELECT COUNT(*) FROM media WHERE chat_id = :chat_id AND file_path LIKE :pattern"),
-        {"chat_id": chat_id, "pattern": pattern},
+# Max avatar renames in flight at once
+AVATAR_RENAME_CONCURRENCY = 32
+# Max chat folder renames/merges in flight at once
+FOLDER_MOVE_CONCURRENCY = 4
+# link() failures meaning "this filesystem can't hard-link" (exFAT, SMB/FUSE mounts, ...)
+_NO_HARDLINK_ERRNOS = frozenset({errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EXDEV, errno.ENOSYS})
+
+
+# Tables holding media paths: (table, path column)
+_PATH_TABLES = (("messages", "media_path"), ("media", "file_path"))
+
+
+def _path_rewrite(table: str, column: str) -> tuple[str, str]:
+    """
+    SQL for rewriting one table's paths via the migrate_map join: (new value, row filter).
+
+    No leading-wildcard LIKE: rows are found through the chat_id indexes and only
+    those REPLACE() actually changes are touched (keeps rowcount exact).
+    """
+    replaced = f"REPLACE({table}.{column}, '/media/' || m.old_folder || '/', '/media/' || m.new_folder || '/')"
+    return replaced, f"{table}.chat_id = m.chat_id AND {table}.{column} IS NOT NULL AND {replaced} <> {table}.{column}"
+
+
+# table -> (path column, new value, row filter)
+_PATH_REWRITES = {table: (column, *_path_rewrite(table, column)) for table, column in _PATH_TABLES}
+
+# Statements are built once at import time and reused
+_SELECT_GROUP_CHATS = text("SELECT id, type, title FROM chats WHERE id < 0 ORDER BY id")
+_CREATE_MIGRATE_MAP = text(
+    "CREATE TEMPORARY TABLE migrate_map (chat_id BIGINT PRIMARY KEY, old_folder TEXT, new_folder TEXT)"
+)
+_FILL_MIGRATE_MAP = text(
+    "INSERT INTO migrate_map (chat_id, old_folder, new_folder) VALUES (:chat_id, :old_folder, :new_folder)"
+)
+_DROP_MIGRATE_MAP = text("DROP TABLE migrate_map")
+# Dry run: both counts in one round trip
+_COUNT_PATHS = text(
+    "SELECT "
+    + ", ".join(
+        f"(SELECT COUNT(*) FROM {table} JOIN migrate_map m ON {match})"
+        for table, (_, _, match) in _PATH_REWRITES.items()
     )
-    media_count = media_result.scalar() or 0
-
-    return {"messages": msg_count, "media": media_count}
-
-
-async def bulk_update_media_paths(session, chat_id: int, old_folder: str, new_folder: str) -> dict:
-    """Bulk update all media paths for a chat using SQL REPLACE - single query per table!"""
-    old_pattern = f"/media/{old_folder}/"
-    new_pattern = f"/media/{new_folder}/"
-
-    # Bulk update messages table
-    msg_result = await session.execute(
-        text("""
-            UPDATE messages
-            SET media_path = REPLACE(media_path, :old_pattern, :new_pattern)
-            WHERE chat_id = :chat_id AND media_path LIKE :like_pattern
-        """),
-        {
-            "chat_id": chat_id,
-            "old_pattern": old_pattern,
-            "new_pattern": new_pattern,
-            "like_pattern": f"%{old_pattern}%",
-        },
+)
+# PostgreSQL: both UPDATEs in one statement via writable CTEs, counting the rows they return
+_UPDATE_PATHS_POSTGRESQL = text(
+    "WITH "
+    + ", ".join(
+        f"upd_{table} AS (UPDATE {table} SET {column} = {replaced} FROM migrate_map m WHERE {match} RETURNING 1)"
+        for table, (column, replaced, match) in _PATH_REWRITES.items()
     )
-    msg_updated = msg_result.rowcount
-
-    # Bulk update media table
-    media_result = await session.execute(
-        text("""
-            UPDATE media
-            SET file_path = REPLACE(file_path, :old_pattern, :new_pattern)
-            WHERE chat_id = :chat_id AND file_path LIKE :like_pattern
-        """),
-        {
-            "chat_id": chat_id,
-            "old_pattern": old_pattern,
-            "new_pattern": new_pattern,
-            "like_pattern": f"%{old_pattern}%",
-        },
+    + " SELECT "
+    + ", ".join(f"(SELECT COUNT(*) FROM upd_{table})" for table in _PATH_REWRITES)
+)
+# SQLite has no writable CTEs - one UPDATE per table
+_UPDATE_PATHS_SQLITE = {
+    table: text(f"UPDATE {table} SET {column} = {replaced} FROM migrate_map m WHERE {match}")
+    for table, (column, replaced, match) in _PATH_REWRITES.items()
+}
+
+
+async def iter_group_channel_chats(session) -> AsyncIterator[dict]:
+    """Stream all chats that are groups/channels/supergroups (have negative IDs)."""
+    result = await session.stream(_SELECT_GROUP_CHATS)
+    async for row in result:
+        yield {"id": row[0], "type": row[1], "title": row[2]}
+
+
+async def bulk_update_media_paths(session, folders: list[tuple[int, str, str]], dry_run: bool) -> dict:
+    """
+    Rewrite media paths for all migrated chats at once - a single query per table!
+
+    The (chat_id, old_folder, new_folder) map is loaded into a temp table and
+    joined by UPDATE ... FROM, instead of one count + update round trip per chat.
+    In dry-run mode the same joins only count the rows that would change, in one query.
+
+    Returns:
+        Rows updated (or that would be updated) per table
+    """
+    await session.execute(_CREATE_MIGRATE_MAP)
+    # One prepared statement, bound per row (executemany - asyncpg pipelines the binds)
+    await session.execute(
+        _FILL_MIGRATE_MAP,
+        [{"chat_id": chat_id, "old_folder": old, "new_folder": new} for chat_id, old, new in folders],
     )
-    media_updated = media_result.rowcount
 
-    return {"messages": msg_updated, "media": media_updated}
+    counts = {}
+    if dry_run:
+        result = await session.execute(_COUNT_PATHS)
+        counts["messages"], counts["media"] = result.one()
+    elif session.bind.dialect.name == "postgresql":
+        result = await session.execute(_UPDATE_PATHS_POSTGRESQL)
+        counts["messages"], counts["media"] = result.one()
+    else:
+        for table, statement in _UPDATE_PATHS_SQLITE.items():
+            result = await session.execute(statement)
+            counts[table] = result.rowcount
+
+    await session.execute(_DROP_MIGRATE_MAP)
+    return counts
+
+
+def rename_path(src: str, dst: str) -> None:
+    """Rename with a single os.rename(), copying via shutil.move() only across devices."""
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst)
+
+
+def move_chat_folder(
+    media_path: str, old_folder: str, new_folder: str, merge: bool, dry_run: bool
+) -> list[tuple[int, str]]:
+    """
+    Rename (or merge, if the new folder already exists) one chat's media folder.
+
+    Runs in a worker thread, so instead of logging it returns (level, message)
+    lines for the caller to emit in order.
+    """
+    old_folder_path = os.path.join(media_path, old_folder)
+    new_folder_path = os.path.join(media_path, new_folder)
+    lines = []
+
+    if not merge:
+        # Simple rename
+        if dry_run:
+            lines.append((logging.INFO, f"   [DRY RUN] Would rename folder: {old_folder}/ → {new_folder}/"))
+            return lines
+        try:
+            rename_path(old_folder_path, new_folder_path)
+            lines.append((logging.INFO, f"   Renamed folder: {old_folder}/ → {new_folder}/"))
+            return lines
+        except OSError as e:
+            # A non-empty new folder appeared since media_path was scanned - merge instead
+            if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                raise
+
+    # New folder already exists - merge contents
+    lines.append((logging.INFO, f"   ⚠️  Both folders exist, merging {old_folder}/ into {new_folder}/"))
+
+    if not dry_run:
+        merge_folder(old_folder_path, new_folder_path)
+        # Remove old folder (should be empty now)
+        try:
+            os.rmdir(old_folder_path)
+            lines.append((logging.INFO, f"   ✓ Removed empty folder: {old_folder}/"))
+        except OSError:
+            lines.append((logging.WARNING, f"   Could not remove folder {old_folder}/ (not empty?)"))
+
+    return lines
+
+
+def merge_folder(old_folder_path: str, new_folder_path: str) -> None:
+    """
+    Move every entry of old_folder_path into new_folder_path, keeping the new copy on conflict.
+
+    Files are moved with link + unlink: link() fails with FileExistsError instead of
+    overwriting (unlike rename() on POSIX), so no separate exists() check is needed.
+    On filesystems without hard links, entries fall back to the checked move.
+    """
+    with os.scandir(old_folder_path) as it:
+        for entry in it:
+            dst = os.path.join(new_folder_path, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                # Directories can't be hard-linked - fall back to the checked move
+                if not os.path.exists(dst):
+                    shutil.move(entry.path, dst)
+                continue
+            try:
+                # File doesn't exist in destination - move it
+                os.link(entry.path, dst, follow_symlinks=False)
+            except FileExistsError:
+                pass  # File exists in both - delete from old folder (keep new)
+            except OSError as e:
+                if e.errno not in _NO_HARDLINK_ERRNOS:
+                    raise
+                # No hard links on this filesystem - checked move instead
+                if not os.path.lexists(dst):
+                    shutil.move(entry.path, dst)
+                    continue
+            os.unlink(entry.path)
+
+
+def split_old_avatar_name(filename: str) -> tuple[str, str] | None:
+    """Split an old-style "positive_id_photoid.jpg" avatar name into (id, photo_id), else None."""
+    if not filename.endswith(".jpg"):
+        return None
+    old_id, sep, photo_id = filename[:-4].partition("_")
+    # isdecimal() accepts exactly what the regex \d did; a leading "-" (already migrated) fails it
+    if not sep or not old_id.isdecimal() or not photo_id.isdecimal():
+        return None
+    return old_id, photo_id
 
 
 async def migrate_avatars(media_path: str, dry_run: bool) -> dict:
@@ -128,23 +256,21 @@ async def migrate_avatars(media_path: str, dry_run: bool) -> dict:
 
     # Pattern: positive_id_photoid.jpg (e.g., 11482744_49777919797605248.jpg)
     # We need to rename to: -11482744_49777919797605248.jpg
-    for filename in os.listdir(chats_avatar_dir):
-        if not filename.endswith(".jpg"):
-            continue
+    # One scandir pass gives us every name, so the "already migrated" check is a set lookup
+    with os.scandir(chats_avatar_dir) as it:
+        filenames = {entry.name for entry in it if entry.is_file(follow_symlinks=False)}
 
+    renames = []
+    for filename in sorted(filenames):
         # Check if it starts with a positive number (no dash)
-        match = re.match(r"^(\d+)_(\d+)\.jpg$", filename)
-        if not match:
+        parts = split_old_avatar_name(filename)
+        if not parts:
             continue  # Already negative or different format
 
-        old_id = match.group(1)
-        photo_id = match.group(2)
+        old_id, photo_id = parts
         new_filename = f"-{old_id}_{photo_id}.jpg"
 
-        old_path = os.path.join(chats_avatar_dir, filename)
-        new_path = os.path.join(chats_avatar_dir, new_filename)
-
-        if os.path.exists(new_path):
+        if new_filename in filenames:
             logger.debug(f"  Avatar already migrated: {filename}")
             stats["skipped"] += 1
             continue
@@ -153,14 +279,25 @@ async def migrate_avatars(media_path: str, dry_run: bool) -> dict:
             logger.info(f"  [DRY RUN] Would rename avatar: {filename} → {new_filename}")
             stats["renamed"] += 1
         else:
+            renames.append((filename, new_filename))
+
+    # Renames are pure metadata syscalls - run them off the event loop, a bounded batch at a time
+    semaphore = asyncio.Semaphore(AVATAR_RENAME_CONCURRENCY)
+
+    async def rename(filename: str, new_filename: str) -> None:
+        async with semaphore:
             try:
-                shutil.move(old_path, new_path)
+                await asyncio.to_thread(
+                    rename_path, os.path.join(chats_avatar_dir, filename), os.path.join(chats_avatar_dir, new_filename)
+                )
                 logger.info(f"  Renamed avatar: {filename} → {new_filename}")
                 stats["renamed"] += 1
             except Exception as e:
                 logger.error(f"  Error renaming avatar {filename}: {e}")
                 stats["errors"] += 1
 
+    await asyncio.gather(*(rename(filename, new_filename) for filename, new_filename in renames))
+
     return stats
 
 
@@ -188,6 +325,14 @@ async def migrate(db_url: str, media_path: str, dry_run: bool = True):
     logger.info(f"Media path: {media_path}")
     logger.info("")
 
+    # Chat folders on disk - one directory read instead of an exists() per chat
+    # (is_dir() follows symlinks so symlinked chat folders still count)
+    try:
+        with os.scandir(media_path) as it:
+            folders = {entry.name for entry in it if entry.is_dir()}
+    except FileNotFoundError:
+        folders = set()
+
     # Create async engine
     engine = create_async_engine(db_url, echo=False)
     async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
@@ -195,73 +340,59 @@ async def migrate(db_url: str, media_path: str, dry_run: bool = True):
     stats = {"chats_processed": 0, "folders_renamed": 0, "paths_updated": 0, "avatars_renamed": 0, "errors": 0}
 
     async with async_session() as session:
-        # Get all group/channel/supergroup chats
-        chats = await get_group_channel_chats(session)
-        logger.info(f"Found {len(chats)} groups/channels/supergroups to check")
-        logger.info("")
-
-        for chat in chats:
+        # Stream all group/channel/supergroup chats, keeping those with an
+        # old-style folder on disk: (chat, old_folder, new_folder)
+        chat_count = 0
+        to_migrate = []
+        async for chat in iter_group_channel_chats(session):
+            chat_count += 1
             chat_id = chat["id"]  # Negative (e.g., -35258041)
             old_folder = str(abs(chat_id))  # Positive (e.g., "35258041")
             new_folder = str(chat_id)  # Negative (e.g., "-35258041")
 
-            old_folder_path = os.path.join(media_path, old_folder)
-            new_folder_path = os.path.join(media_path, new_folder)
-
             # Check if old folder exists
-            if not os.path.exists(old_folder_path):
-                continue  # Nothing to migrate for this chat
-
-            stats["chats_processed"] += 1
-            logger.info(f"📁 Chat {chat_id} ({chat['type']}): {chat['title']}")
-
-            # Count paths that need updating
-            counts = await count_paths_for_chat(session, chat_id, old_folder)
+            if old_folder in folders:
+                to_migrate.append((chat, old_folder, new_folder))
 
-            if counts["messages"] > 0 or counts["media"] > 0:
-                logger.info(f"   Found {counts['messages']} message + {counts['media']} media paths to update")
+        logger.info(f"Found {chat_count} groups/channels/supergroups to check")
+        logger.info("")
 
-                if dry_run:
-                    logger.debug("   [DRY RUN] Would bulk update paths")
-                    stats["paths_updated"] += counts["messages"] + counts["media"]
-                else:
-                    # BULK UPDATE - single query per table instead of one per row!
-                    updated = await bulk_update_media_paths(session, chat_id, old_folder, new_folder)
-                    stats["paths_updated"] += updated["messages"] + updated["media"]
-                    logger.info(f"   ✓ Updated {updated['messages']} message + {updated['media']} media paths")
-
-            # Rename the folder
-            if os.path.exists(new_folder_path):
-                # New folder already exists - merge contents
-                logger.info(f"   ⚠️  Both folders exist, merging {old_folder}/ into {new_folder}/")
-
-                if not dry_run:
-                    for item in os.listdir(old_folder_path):
-                        src = os.path.join(old_folder_path, item)
-                        dst = os.path.join(new_folder_path, item)
-                        if not os.path.exists(dst):
-                            # File doesn't exist in destination - move it
-                            shutil.move(src, dst)
-                        else:
-                            # File exists in both - delete from old folder (keep new)
-                            os.remove(src)
-                    # Remove old folder (should be empty now)
-                    try:
-                        os.rmdir(old_folder_path)
-                        logger.info(f"   ✓ Removed empty folder: {old_folder}/")
-                    except OSError:
-                        logger.warning(f"   Could not remove folder {old_folder}/ (not empty?)")
-
-                stats["folders_renamed"] += 1
-            else:
-                # Simple rename
-                if dry_run:
-                    logger.info(f"   [DRY RUN] Would rename folder: {old_folder}/ → {new_folder}/")
+        # Folder moves run in threads, a bounded number at a time. A failed move is
+        # logged and counted, and only chats whose folder moved get their paths rewritten.
+        semaphore = asyncio.Semaphore(FOLDER_MOVE_CONCURRENCY)
+
+        async def move_folder(old_folder: str, new_folder: str) -> tuple[bool, list[tuple[int, str]]]:
+            async with semaphore:
+                try:
+                    return True, await asyncio.to_thread(
+                        move_chat_folder, media_path, old_folder, new_folder, new_folder in folders, dry_run
+                    )
+                except OSError as e:
+                    return False, [(logging.ERROR, f"   Error moving folder {old_folder}/ → {new_folder}/: {e}")]
+
+        if to_migrate:
+            results = await asyncio.gather(*(move_folder(old, new) for _, old, new in to_migrate))
+
+            # Log per-chat results in chat order, not completion order
+            moved = []
+            for (chat, old, new), (ok, lines) in zip(to_migrate, results, strict=True):
+                stats["chats_processed"] += 1
+                logger.info(f"📁 Chat {chat['id']} ({chat['type']}): {chat['title']}")
+                for level, line in lines:
+                    logger.log(level, line)
+                if ok:
+                    stats["folders_renamed"] += 1
+                    moved.append((chat["id"], old, new))
                 else:
-                    shutil.move(old_folder_path, new_folder_path)
-                    logger.info(f"   Renamed folder: {old_folder}/ → {new_folder}/")
+                    stats["errors"] += 1
+            logger.info("")
 
-                stats["folders_renamed"] += 1
+            if moved:
+                # BULK UPDATE - one query per table for all moved chats
+                updated = await bulk_update_media_paths(session, moved, dry_run)
+                stats["paths_updated"] += updated["messages"] + updated["media"]
+                verb = "Would update" if dry_run else "✓ Updated"
+                logger.info(f"{verb} {updated['messages']} message + {updated['media']} media paths")
 
         # Migrate avatars
         logger.info("")
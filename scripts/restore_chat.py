@@ -7,7 +7,8 @@ Restore chat history from backup to Telegram.
 IMPORTANT LIMITATIONS:
 - Messages will be sent as YOU (the logged-in user), not the original sender
 - Original timestamps are shown in message text, not as actual message time
-- Media is re-uploaded as new files
+- Media is re-uploaded as new files (runs of up to 10 photos/videos, documents or
+  audio files from the same sender within a minute are sent as one album)
 - Telegram rate limits apply (~30 messages/minute for safety)
 
 This is a Telegram API limitation - there is no way to send messages
@@ -92,6 +93,37 @@ async def get_telegram_client():
     return client
 
 
+# Shared stand-in for messages without sender info (never mutated)
+_NO_SENDER: dict[str, Any] = {}
+
+# Media types Telegram accepts together in one album (photos and videos may be mixed)
+ALBUM_KINDS = {"photo": "visual", "video": "visual", "document": "document", "audio": "audio"}
+ALBUM_MAX_ITEMS = 10
+ALBUM_WINDOW_SECONDS = 60
+
+
+def truncate_caption(text: str) -> str:
+    """Fit text into a media caption (limit is 1024 chars for photos/videos)."""
+    return text if len(text) <= 1024 else text[:1021] + "..."
+
+
+def can_join_album(batch: list[dict[str, Any]], item: dict[str, Any]) -> bool:
+    """Whether item continues the album run in batch (same sender, compatible media, close in time)."""
+    last = batch[-1]
+    kind = ALBUM_KINDS.get(item["msg"].get("media_type"))
+    return (
+        len(batch) < ALBUM_MAX_ITEMS
+        and kind is not None
+        and kind == ALBUM_KINDS.get(last["msg"].get("media_type"))
+        and item["media_file"] is not None
+        and last["media_file"] is not None
+        and item["sender_name"] == last["sender_name"]
+        and item["date"] is not None
+        and last["date"] is not None
+        and (item["date"] - last["date"]).total_seconds() < ALBUM_WINDOW_SECONDS
+    )
+
+
 def format_message_header(sender_name: str, date: datetime) -> str:
     """Format the message header with sender and timestamp."""
     date_str = date.strftime("%Y-%m-%d %H:%M") if date else "Unknown date"
@@ -113,6 +145,36 @@ def parse_msg_date(msg: dict[str, Any]) -> datetime | None:
     return None
 
 
+def media_file_exists(path: str, dir_cache: dict[str, frozenset[str]]) -> bool:
+    """os.path.exists() for media files, backed by a single scandir per directory."""
+    folder, name = os.path.split(path)
+    names = dir_cache.get(folder)
+    if names is None:
+        try:
+            with os.scandir(folder) as it:
+                # is_file() follows symlinks, so dangling dedup links count as missing
+                names = frozenset(entry.name for entry in it if entry.is_file())
+        except OSError:
+            names = frozenset()
+        dir_cache[folder] = names
+    return name in names
+
+
+def msg_date_key(msg: dict[str, Any]) -> str | None:
+    """Naive ISO-8601 date string of a message, for chronological comparisons without parsing."""
+    d = msg.get("date")
+    if isinstance(d, datetime):
+        return d.replace(tzinfo=None).isoformat()
+    if not isinstance(d, str) or not d:
+        return None
+    # Drop a UTC offset so the string orders like parse_msg_date(...).replace(tzinfo=None)
+    if d.endswith("Z"):
+        return d[:-1]
+    if len(d) > 19 and d[-6] in "+-":
+        return d[:-6]
+    return d
+
+
 async def restore_chat(
     source_chat_id: int,
     dest_chat_id: int,
@@ -161,40 +223,41 @@ async def restore_chat(
     logger.info(f"Destination: {'Same chat' if source_chat_id == dest_chat_id else dest_chat_id}")
 
     # Get messages from backup (with media info)
+    # get_messages_for_export streams oldest first (ORDER BY date), so filters and the
+    # limit are applied on the fly and the scan stops as soon as --before is passed or
+    # --limit messages have been collected. Filters compare ISO-8601 strings directly
+    # (they sort chronologically); dates are only parsed for the header of sent messages.
     logger.info("Loading messages from backup...")
+    after_key = after_date.isoformat() if after_date else None
+    before_key = before_date.isoformat() if before_date else None
     messages = []
+    scanned = 0
     async for msg in db.get_messages_for_export(source_chat_id, include_media=True):
+        scanned += 1
+        date_key = msg_date_key(msg)
+        if after_key and not (date_key and date_key > after_key):
+            continue
+        if before_key and not (date_key and date_key < before_key):
+            if date_key:
+                break  # Every later message is newer still
+            continue
         messages.append(msg)
+        if limit and len(messages) >= limit:
+            logger.info(f"Limited to {limit} messages")
+            break
 
-    if not messages:
+    if not scanned:
         logger.warning("No messages found in backup for this chat!")
         return
 
-    logger.info(f"Found {len(messages)} messages in backup")
-
-    # Filter by date
-    if after_date:
-        messages = [m for m in messages if parse_msg_date(m) and parse_msg_date(m).replace(tzinfo=None) > after_date]
-        logger.info(f"After date filter: {len(messages)} messages remaining")
-
-    if before_date:
-        messages = [m for m in messages if parse_msg_date(m) and parse_msg_date(m).replace(tzinfo=None) < before_date]
-        logger.info(f"Before date filter: {len(messages)} messages remaining")
-
-    # Sort by date (oldest first for chronological restore)
-    messages.sort(key=lambda m: parse_msg_date(m) or datetime.min)
-
-    # Apply limit
-    if limit and len(messages) > limit:
-        messages = messages[:limit]
-        logger.info(f"Limited to {limit} messages")
+    logger.info(f"Scanned {scanned} messages in backup, {len(messages)} selected")
 
     if not messages:
         logger.warning("No messages to restore after filtering!")
         return
 
     # Count media
-    media_count = sum(1 for m in messages if m.get("media_path") and include_media)
+    media_count = sum(1 for m in messages if m.get("media_path")) if include_media else 0
     logger.info(f"\nWill restore {len(messages)} messages ({media_count} with media)")
     logger.info(f"Estimated time: ~{len(messages) * delay / 60:.1f} minutes (with {delay}s delay)")
 
@@ -204,10 +267,9 @@ async def restore_chat(
     if dry_run:
         logger.info("\n--- DRY RUN PREVIEW (first 10 messages) ---")
         for msg in messages[:10]:
-            sender_name = msg.get("sender", {}).get("name", "Unknown")
-            msg_date = parse_msg_date(msg)
-            header = format_message_header(sender_name, msg_date)
-            text = (msg.get("text", "") or "")[:80]
+            sender_name = (msg.get("sender") or _NO_SENDER).get("name", "Unknown")
+            header = format_message_header(sender_name, parse_msg_date(msg))
+            text = (msg.get("text") or "")[:80]
             media_info = ""
             if msg.get("media_path") and include_media:
                 media_path = os.path.join(media_base_path, msg["media_path"])
@@ -247,52 +309,79 @@ async def restore_chat(
     sent_count = 0
     media_sent = 0
     error_count = 0
-
-    for i, msg in enumerate(messages, 1):
+    loop = asyncio.get_running_loop()
+    media_dirs: dict[str, frozenset[str]] = {}
+
+    # Prepare every message (header + media lookup) up front so album runs can be grouped
+    outgoing = []
+    for msg in messages:
+        # Get sender info
+        sender_name = (msg.get("sender") or _NO_SENDER).get("name", "Unknown")
+        msg_date = parse_msg_date(msg)
+
+        # Format message with header
+        header = format_message_header(sender_name, msg_date)
+        text = msg.get("text") or ""
+        full_text = f"{header}\n{text}" if text else header
+
+        # Check for media
+        media_file = None
+        msg_media_path = msg.get("media_path") if include_media else None
+        if msg_media_path:
+            potential_path = os.path.join(media_base_path, msg_media_path)
+            if media_file_exists(potential_path, media_dirs):
+                media_file = potential_path
+            else:
+                logger.warning(f"Media file not found: {potential_path}")
+
+        if not media_file and not full_text.strip():
+            continue  # Skip empty messages with no media
+
+        item = {
+            "msg": msg,
+            "sender_name": sender_name,
+            "date": msg_date,
+            "full_text": full_text,
+            "media_file": media_file,
+        }
+        if outgoing and can_join_album(outgoing[-1], item):
+            outgoing[-1].append(item)
+        else:
+            outgoing.append([item])
+
+    processed = 0
+    for batch in outgoing:
+        msg = batch[0]["msg"]
+        processed += len(batch)
         try:
-            # Get sender info
-            sender_name = msg.get("sender", {}).get("name", "Unknown")
-            msg_date = parse_msg_date(msg)
-
-            # Format message with header
-            header = format_message_header(sender_name, msg_date)
-            text = msg.get("text", "") or ""
-            full_text = f"{header}\n{text}" if text else header
-
-            # Check for media
-            media_file = None
-            if include_media and msg.get("media_path"):
-                potential_path = os.path.join(media_base_path, msg["media_path"])
-                if os.path.exists(potential_path):
-                    media_file = potential_path
-                else:
-                    logger.warning(f"Media file not found: {potential_path}")
-
-            # Send message with media (combined) or text only
-            if media_file:
+            # Send message with media (combined), an album of media, or text only
+            send_started = loop.time()
+            if len(batch) > 1:
+                # One request for the whole run, each item keeping its own caption
+                await client.send_file(
+                    dest_chat_id,
+                    [item["media_file"] for item in batch],
+                    caption=[truncate_caption(item["full_text"]) for item in batch],
+                )
+                media_sent += len(batch)
+            elif batch[0]["media_file"]:
                 # Send media with caption (text as caption)
-                # For photos/videos, caption limit is 1024 chars
-                caption = full_text[:1024] if len(full_text) <= 1024 else full_text[:1021] + "..."
-
-                await client.send_file(dest_chat_id, media_file, caption=caption)
+                caption = truncate_caption(batch[0]["full_text"])
+                await client.send_file(dest_chat_id, batch[0]["media_file"], caption=caption)
                 media_sent += 1
-                sent_count += 1
-
-            elif full_text.strip():
-                # Text-only message
-                await client.send_message(dest_chat_id, full_text)
-                sent_count += 1
             else:
-                # Skip empty messages with no media
-                continue
+                # Text-only message
+                await client.send_message(dest_chat_id, batch[0]["full_text"])
 
             # Progress logging
-            if sent_count % 10 == 0:
-                pct = i / len(messages) * 100
+            previous_count, sent_count = sent_count, sent_count + len(batch)
+            if sent_count // 10 > previous_count // 10:
+                pct = processed / len(messages) * 100
                 logger.info(f"Progress: {sent_count}/{len(messages)} messages ({pct:.1f}%) - {media_sent} with media")
 
-            # Rate limiting delay - wait for upload to complete before continuing
-            await asyncio.sleep(delay)
+            # Rate limiting delay - sends start at most one per `delay` seconds (an album
+            # counts once), and upload time counts towards it instead of being added on top
+            await asyncio.sleep(max(0.0, send_started + delay - loop.time()))
 
         except FloodWaitError as e:
             logger.warning(f"Flood wait: sleeping {e.seconds} seconds...")
@@ -16,6 +16,9 @@ Usage:
 
     # Update all records, even those with existing sizes
     python -m scripts.update_media_sizes --force
+
+    # Commit every 10 update batches (10,000 rows) instead of every batch
+    python -m scripts.update_media_sizes --commit-every 10
 """
 
 import argparse
@@ -23,11 +26,15 @@ import asyncio
 import logging
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
-# Add parent directory to path for imports
-sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Add parent directory to path for imports - only needed when run as a plain script;
+# `python -m scripts.update_media_sizes` already has the project root on sys.path
+if not __package__:
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from sqlalchemy import text
+from sqlalchemy import BigInteger, String, bindparam, text
+from sqlalchemy.dialects.postgresql import ARRAY
 
 from src.config import Config
 from src.db import create_adapter
@@ -35,55 +42,133 @@ from src.db import create_adapter
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
+# Records per stat/update batch
+BATCH_SIZE = 1000
+
+
+# Size refresh statements, built once per dialect. Ids and sizes are always bound,
+# never interpolated into the SQL. Rows whose size already matches are left alone
+# (no dead tuples/WAL on --force re-runs).
+# PostgreSQL: the whole batch travels as two arrays, so the statement text (and
+# its plan) is the same whatever the batch size
+_UPDATE_SIZES_POSTGRESQL = text("""
+    UPDATE media
+    SET file_size = v.size
+    FROM unnest(:ids, :sizes) AS v(id, size)
+    WHERE media.id = v.id AND media.file_size IS DISTINCT FROM v.size
+""").bindparams(bindparam("ids", type_=ARRAY(String)), bindparam("sizes", type_=ARRAY(BigInteger)))
+# SQLite: one prepared statement, bound per row (executemany)
+_UPDATE_SIZE_SQLITE = text("UPDATE media SET file_size = :size WHERE id = :id AND file_size IS NOT :size")
 
-async def _bulk_update_sizes(session, updates: list):
+
+async def _bulk_update_sizes_postgresql(session, updates: list) -> int:
     """
-    Bulk update file sizes using a single SQL query with CASE statement.
-    Much faster than individual UPDATEs - does 1000 rows in one round-trip!
+    Bulk update file sizes in one round-trip per batch - UPDATE FROM unnest(ids, sizes).
 
     Args:
         session: SQLAlchemy async session
         updates: List of (media_id, file_size) tuples
+
+    Returns:
+        Number of rows whose size actually changed
     """
     if not updates:
-        return
+        return 0
+    result = await session.execute(
+        _UPDATE_SIZES_POSTGRESQL,
+        {"ids": [mid for mid, _ in updates], "sizes": [size for _, size in updates]},
+    )
+    return result.rowcount
+
+
+async def _bulk_update_sizes_sqlite(session, updates: list) -> int:
+    """
+    Bulk update file sizes - executemany reuses the statement plan for every row.
+
+    Args:
+        session: SQLAlchemy async session
+        updates: List of (media_id, file_size) tuples
+
+    Returns:
+        Number of rows whose size actually changed
+    """
+    if not updates:
+        return 0
+    result = await session.execute(_UPDATE_SIZE_SQLITE, [{"id": mid, "size": size} for mid, size in updates])
+    return result.rowcount
+
 
-    # Build a VALUES clause and UPDATE with JOIN
-    # PostgreSQL: UPDATE media SET file_size = v.size FROM (VALUES ...) AS v(id, size) WHERE media.id = v.id
-    # SQLite: Use CASE WHEN approach
-
-    # Detect database type from connection
-    dialect = session.bind.dialect.name
-
-    if dialect == "postgresql":
-        # PostgreSQL - use UPDATE FROM VALUES (fastest)
-        values_str = ", ".join(f"('{mid}', {size})" for mid, size in updates)
-        query = text(f"""
-            UPDATE media
-            SET file_size = v.size::bigint
-            FROM (VALUES {values_str}) AS v(id, size)
-            WHERE media.id = v.id
-        """)
-    else:
-        # SQLite - use CASE WHEN
-        case_clauses = " ".join(f"WHEN '{mid}' THEN {size}" for mid, size in updates)
-        ids = ", ".join(f"'{mid}'" for mid, _ in updates)
-        query = text(f"""
-            UPDATE media
-            SET file_size = CASE id {case_clauses} END
-            WHERE id IN ({ids})
-        """)
-
-    await session.execute(query)
-
-
-async def update_media_sizes(dry_run: bool = False, force: bool = False):
+async def _write_batch(bulk_update, session, updates: list, commit: bool) -> int:
+    """
+    Write one batch of sizes (and optionally commit) - run as a task so it
+    overlaps with statting the next batch.
+
+    Args:
+        bulk_update: _bulk_update_sizes_postgresql or _bulk_update_sizes_sqlite
+        session: SQLAlchemy async session to write through
+        updates: List of (media_id, file_size) tuples
+        commit: Commit the session after the update
+
+    Returns:
+        Number of rows whose size actually changed
+    """
+    changed = await bulk_update(session, updates)
+    if commit:
+        await session.commit()
+    return changed
+
+
+def _resolve_media_path(media, base_prefix: str, chat_dirs: dict[int, str]) -> str | None:
+    """
+    Full path of a media record's file, or None if the record doesn't say where it is.
+
+    Args:
+        media: Row with file_path, chat_id and file_name
+        base_prefix: Media base path with a trailing separator
+        chat_dirs: Cache of chat_id -> chat media directory, filled as chats are seen
+    """
+    file_path = media.file_path
+    if file_path:
+        # file_path might be absolute or relative
+        return file_path if file_path.startswith("/") else base_prefix + file_path
+    # Fallback: construct from chat_id and file_name
+    chat_id = media.chat_id
+    if chat_id and media.file_name:
+        chat_dir = chat_dirs.get(chat_id)
+        if chat_dir is None:
+            chat_dir = chat_dirs[chat_id] = base_prefix + str(chat_id)
+        return os.path.join(chat_dir, media.file_name)
+    return None
+
+
+def _stat_size(full_path: str) -> int | OSError:
+    """File size via a single stat() - a failure is returned, not raised, so one batch can't abort."""
+    try:
+        return os.stat(full_path).st_size
+    except OSError as e:
+        return e
+
+
+def _list_dir(path: str) -> frozenset[str] | None:
+    """Names in a directory - None if it doesn't exist, empty if it can't be read."""
+    try:
+        with os.scandir(path) as it:
+            return frozenset(entry.name for entry in it)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    except OSError:
+        return frozenset()
+
+
+async def update_media_sizes(dry_run: bool = False, force: bool = False, stat_threads: int = 32, commit_every: int = 1):
     """
     Update file sizes for media records in the database.
 
     Args:
         dry_run: If True, only report what would be done without making changes
         force: If True, update all records including those with existing sizes
+        stat_threads: Number of threads issuing stat() calls in parallel
+        commit_every: Number of BATCH_SIZE update batches per transaction
     """
     config = Config()
     db = await create_adapter()
@@ -97,95 +182,163 @@ async def update_media_sizes(dry_run: bool = False, force: bool = False):
     logger.info(f"Dry run: {dry_run}")
     logger.info(f"Force update all: {force}")
 
-    # Get media records that need updating
-    async with db.db_manager.async_session_factory() as session:
-        from sqlalchemy import select
+    # Get media records that need updating. Rows are streamed by one session while
+    # size updates are committed through another - committing would end the read.
+    async with (
+        db.db_manager.async_session_factory() as session,
+        db.db_manager.async_session_factory() as write_session,
+    ):
+        from sqlalchemy import and_, func, or_, select
 
-        from src.db.models import Media
-
-        # Media types that have actual downloadable files
-        DOWNLOADABLE_TYPES = ["photo", "video", "audio", "voice", "document", "sticker", "animation"]
-        # Types without files (just metadata): geo, poll, contact, venue, etc.
+        from src.db.models import DOWNLOADABLE_MEDIA_TYPES, MEDIA_NEEDS_SIZE_WHERE, Media
 
         # Build query - only downloadable types, exclude non-file types
-        base_filter = Media.type.in_(DOWNLOADABLE_TYPES)
-
         if force:
-            query = select(Media).where(base_filter)
+            filters = (Media.type.in_(DOWNLOADABLE_MEDIA_TYPES),)
             logger.info("Fetching ALL downloadable media records...")
         else:
-            query = select(Media).where(base_filter, (Media.file_size == None) | (Media.file_size == 0))
+            # Literal predicate, so the idx_media_needs_size partial index matches
+            filters = (text(MEDIA_NEEDS_SIZE_WHERE),)
             logger.info("Fetching downloadable media records with missing file sizes...")
 
         logger.info("(Skipping non-file types: geo, poll, contact, venue, etc.)")
 
-        result = await session.execute(query)
-        media_records = result.scalars().all()
+        # Rows with neither file_path nor chat_id + file_name can't be located -
+        # count them but leave them in the database instead of streaming them
+        locatable = or_(Media.file_path.isnot(None), and_(Media.chat_id.isnot(None), Media.file_name.isnot(None)))
 
-        logger.info(f"Found {len(media_records)} records to process")
+        # Count up front (for progress), then stream the rows a batch at a time
+        all_count, total = (
+            await session.execute(
+                select(func.count(), func.count().filter(locatable)).select_from(Media).where(*filters)
+            )
+        ).one()
+        unlocatable = all_count - total
+        filters = (*filters, locatable)
+
+        logger.info(f"Found {all_count} records to process")
+        if unlocatable:
+            logger.warning(f"Skipping {unlocatable} records with no file_path or chat_id/file_name")
 
         updated_count = 0
+        changed_count = 0  # rows whose stored size was actually different
         missing_count = 0
-        error_count = 0
+        error_count = unlocatable
         total_size_added = 0
 
-        BATCH_SIZE = 1000
         pending_updates = []  # Collect updates for bulk execution
 
-        for i, media in enumerate(media_records):
-            # Flush batch and report progress
-            if i % BATCH_SIZE == 0 and i > 0:
-                if pending_updates and not dry_run:
-                    # BULK UPDATE using VALUES - single query for entire batch!
-                    await _bulk_update_sizes(session, pending_updates)
-                    await session.commit()
-                    pending_updates = []
-                logger.info(
-                    f"Progress: {i}/{len(media_records)} ({updated_count} updated, {missing_count} missing) - committed"
+        # Only the columns needed to locate the file - plain rows, no ORM objects
+        result = await session.stream(
+            select(Media.id, Media.file_path, Media.chat_id, Media.file_name)
+            .where(*filters)
+            # Chat by chat, so consecutive stats hit the same directory
+            .order_by(Media.chat_id, Media.file_name)
+            .execution_options(yield_per=BATCH_SIZE)
+        )
+
+        # Detect database type once, not per batch
+        if write_session.bind.dialect.name == "postgresql":
+            bulk_update = _bulk_update_sizes_postgresql
+        else:
+            bulk_update = _bulk_update_sizes_sqlite
+
+        loop = asyncio.get_running_loop()
+        dir_listings: dict[str, frozenset[str] | None] = {}  # directory -> names in it (None: missing)
+        missing_dirs = set()  # missing directories already reported
+        base_prefix = os.path.join(media_base_path, "")
+        chat_dirs: dict[int, str] = {}  # chat_id -> media directory
+        with ThreadPoolExecutor(max_workers=stat_threads) as executor:
+            i = 0
+            uncommitted_batches = 0
+            write_task = None  # previous batch's write, running while this batch is statted
+            async for media_records in result.partitions(BATCH_SIZE):
+                # Flush batch and report progress
+                if i > 0:
+                    committed = ""
+                    if pending_updates and not dry_run:
+                        uncommitted_batches += 1
+                        commit = uncommitted_batches >= commit_every
+                        if commit:
+                            uncommitted_batches = 0
+                            committed = " - committed"
+                        # One write in flight at a time on write_session
+                        if write_task is not None:
+                            changed_count += await write_task
+                        # BULK UPDATE - single query for entire batch, overlapping the next batch's stats
+                        write_task = asyncio.create_task(_write_batch(bulk_update, write_session, pending_updates, commit))
+                        pending_updates = []
+                    logger.info(f"Progress: {i}/{total} ({updated_count} updated, {missing_count} missing){committed}")
+                i += len(media_records)
+
+                batch = []
+                for media in media_records:
+                    full_path = _resolve_media_path(media, base_prefix, chat_dirs)
+                    if full_path is None:
+                        error_count += 1
+                    else:
+                        batch.append((media.id, full_path))
+
+                # List each directory once (one scandir, no per-file syscalls), so files
+                # that aren't there are known missing without a stat()
+                new_dirs = {os.path.dirname(full_path) for _, full_path in batch} - dir_listings.keys()
+                listings = await asyncio.gather(*(loop.run_in_executor(executor, _list_dir, d) for d in new_dirs))
+                dir_listings.update(zip(new_dirs, listings, strict=True))
+
+                # stat() the files that are present in parallel - on network/multi-disk storage
+                # many lookups can be in flight at once; results come back in batch order
+                present = []
+                for _, full_path in batch:
+                    listing = dir_listings[os.path.dirname(full_path)]
+                    present.append(listing is not None and os.path.basename(full_path) in listing)
+                sizes = iter(
+                    await asyncio.gather(
+                        *(
+                            loop.run_in_executor(executor, _stat_size, full_path)
+                            for (_, full_path), listed in zip(batch, present, strict=True)
+                            if listed
+                        )
+                    )
                 )
 
-            # Construct full path
-            if media.file_path:
-                # file_path might be absolute or relative
-                if media.file_path.startswith("/"):
-                    full_path = media.file_path
-                else:
-                    full_path = os.path.join(media_base_path, media.file_path)
-            else:
-                # Fallback: construct from chat_id and file_name
-                if media.chat_id and media.file_name:
-                    full_path = os.path.join(media_base_path, str(media.chat_id), media.file_name)
-                else:
-                    error_count += 1
-                    continue
-
-            # Check if file exists and get size
-            if os.path.exists(full_path):
-                try:
-                    file_size = os.path.getsize(full_path)
-                    pending_updates.append((media.id, file_size))
-                    updated_count += 1
-                    total_size_added += file_size
-                except Exception as e:
-                    logger.error(f"Error processing {full_path}: {e}")
-                    error_count += 1
-            else:
-                missing_count += 1
-                if missing_count <= 10:  # Only log first 10 missing files
-                    logger.warning(f"File not found: {full_path}")
+                for (media_id, full_path), listed in zip(batch, present, strict=True):
+                    file_size = next(sizes) if listed else None
+                    if file_size is None or isinstance(file_size, FileNotFoundError):
+                        missing_count += 1
+                        folder = os.path.dirname(full_path)
+                        if dir_listings[folder] is None:
+                            # Whole directory is gone - report it once, not every file in it
+                            if folder not in missing_dirs and len(missing_dirs) < 10:
+                                logger.warning(f"Directory not found: {folder}")
+                            missing_dirs.add(folder)
+                        elif missing_count <= 10:  # Only log first 10 missing files
+                            logger.warning(f"File not found: {full_path}")
+                    elif isinstance(file_size, OSError):
+                        logger.error(f"Error processing {full_path}: {file_size}")
+                        error_count += 1
+                    else:
+                        pending_updates.append((media_id, file_size))
+                        updated_count += 1
+                        total_size_added += file_size
 
         # Flush remaining updates
+        if write_task is not None:
+            changed_count += await write_task
         if pending_updates and not dry_run:
-            await _bulk_update_sizes(session, pending_updates)
-            await session.commit()
+            changed_count += await bulk_update(write_session, pending_updates)
+            uncommitted_batches += 1
+        if uncommitted_batches:
+            await write_session.commit()
             logger.info("Final batch committed to database")
 
         # Summary
         logger.info("=" * 60)
         logger.info("SUMMARY")
         logger.info("=" * 60)
-        logger.info(f"Total records processed: {len(media_records)}")
+        logger.info(f"Total records processed: {i + unlocatable}")
         logger.info(f"Updated: {updated_count}")
+        if not dry_run:
+            logger.info(f"Changed in database: {changed_count}")
         logger.info(f"Missing files: {missing_count}")
         logger.info(f"Errors: {error_count}")
         logger.info(f"Total size added: {total_size_added / (1024 * 1024 * 1024):.2f} GB")
@@ -199,10 +352,26 @@ def main():
     parser = argparse.ArgumentParser(description="Update file sizes for media records in the database")
     parser.add_argument("--dry-run", action="store_true", help="Show what would be done without making changes")
     parser.add_argument("--force", action="store_true", help="Update all records, even those with existing sizes")
+    parser.add_argument(
+        "--stat-threads",
+        type=int,
+        default=32,
+        help="Parallel stat() calls - raise for network/multi-disk storage (default: 32)",
+    )
+    parser.add_argument(
+        "--commit-every",
+        type=int,
+        default=1,
+        help=f"Number of {BATCH_SIZE}-row update batches per commit (default: 1)",
+    )
 
     args = parser.parse_args()
 
-    asyncio.run(update_media_sizes(dry_run=args.dry_run, force=args.force))
+    asyncio.run(
+        update_media_sizes(
+            dry_run=args.dry_run, force=args.force, stat_threads=args.stat_threads, commit_every=args.commit_every
+        )
+    )
 
 
 if __name__ == "__main__":
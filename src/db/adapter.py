@@ -6,7 +6,6 @@ This is a drop-in replacement for the old Database class.
 """
 
 import asyncio
-import glob
 import json
 import logging
 import os
@@ -15,12 +14,24 @@ from datetime import datetime
 from functools import wraps
 from typing import Any
 
-from sqlalchemy import and_, delete, func, or_, select, text, update
+from sqlalchemy import and_, delete, func, literal_column, or_, select, text, update
 from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 from .base import DatabaseManager
-from .models import Chat, ChatFolder, ChatFolderMember, ForumTopic, Media, Message, Metadata, Reaction, SyncStatus, User
+from .models import (
+    Chat,
+    ChatFolder,
+    ChatFolderMember,
+    ForumTopic,
+    Media,
+    Message,
+    Metadata,
+    PushSubscription,
+    Reaction,
+    SyncStatus,
+    User,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -34,6 +45,84 @@ def _strip_tz(dt: datetime | None) -> datetime | None:
     return dt
 
 
+def _build_upsert(insert, model, index_elements: list[str], columns: list[str]):
+    """
+    INSERT ... ON CONFLICT DO UPDATE for model, taking every value from the
+    executed parameters (EXCLUDED.*) so one statement serves all rows.
+
+    Args:
+        insert: sqlite_insert or pg_insert
+        model: ORM model to upsert into
+        index_elements: Conflict target columns
+        columns: Columns overwritten on conflict
+    """
+    stmt = insert(model)
+    return stmt.on_conflict_do_update(
+        index_elements=index_elements, set_={column: stmt.excluded[column] for column in columns}
+    )
+
+
+# Columns overwritten when an existing row is upserted again
+_MESSAGE_UPSERT_COLUMNS = [
+    "sender_id",
+    "date",
+    "text",
+    "reply_to_msg_id",
+    "reply_to_top_id",
+    "reply_to_text",
+    "forward_from_id",
+    "edit_date",
+    "raw_data",
+    "is_outgoing",
+]
+_MEDIA_UPSERT_COLUMNS = [
+    "message_id",
+    "chat_id",
+    "type",
+    "file_name",
+    "file_path",
+    "file_size",
+    "mime_type",
+    "width",
+    "height",
+    "duration",
+    "downloaded",
+    "download_date",
+]
+_USER_UPSERT_COLUMNS = ["username", "first_name", "last_name", "phone", "is_bot", "updated_at"]
+
+
+def _delete_chat_files(media_base_path: str, chat_id: int) -> None:
+    """Remove a chat's media folder and avatar files (blocking, run in a thread)."""
+    chat_media_dir = os.path.join(media_base_path, str(chat_id))
+    if os.path.exists(chat_media_dir):
+        try:
+            shutil.rmtree(chat_media_dir)
+            logger.info(f"Deleted media folder: {chat_media_dir}")
+        except Exception as e:
+            logger.error(f"Failed to delete media folder {chat_media_dir}: {e}")
+
+    # <chat_id>_<photo_id>.jpg, plus the legacy <chat_id>.jpg
+    prefix = f"{chat_id}_"
+    legacy_name = f"{chat_id}.jpg"
+    for avatar_type in ["chats", "users"]:
+        try:
+            with os.scandir(os.path.join(media_base_path, "avatars", avatar_type)) as entries:
+                avatar_files = [
+                    entry.path
+                    for entry in entries
+                    if entry.name == legacy_name or (entry.name.startswith(prefix) and entry.name.endswith(".jpg"))
+                ]
+        except FileNotFoundError:
+            continue
+        for avatar_file in avatar_files:
+            try:
+                os.remove(avatar_file)
+                logger.info(f"Deleted avatar file: {avatar_file}")
+            except Exception as e:
+                logger.error(f"Failed to delete avatar {avatar_file}: {e}")
+
+
 def retry_on_locked(
     max_retries: int = 5, initial_delay: float = 0.1, max_delay: float = 2.0, backoff_factor: float = 2.0
 ):
@@ -94,7 +183,18 @@ class DatabaseAdapter:
         self.db_manager = db_manager
         self._is_sqlite = db_manager._is_sqlite
 
-    def _serialize_raw_data(self, raw_data: Any) -> str:
+        # Upserts for the hot write paths, built once so SQLAlchemy compiles each
+        # a single time instead of per row (values are bound at execute time)
+        insert = sqlite_insert if self._is_sqlite else pg_insert
+        self._upsert_message = _build_upsert(insert, Message, ["id", "chat_id"], _MESSAGE_UPSERT_COLUMNS)
+        # Batch inserts also carry the pinned flag
+        self._upsert_message_pinned = _build_upsert(
+            insert, Message, ["id", "chat_id"], [*_MESSAGE_UPSERT_COLUMNS, "is_pinned"]
+        )
+        self._upsert_media = _build_upsert(insert, Media, ["id"], _MEDIA_UPSERT_COLUMNS)
+        self._upsert_user = _build_upsert(insert, User, ["id"], _USER_UPSERT_COLUMNS)
+
+    def _serialize_raw_data(self, raw_data: Any) -> str | None:
         """
         Safely serialize raw_data to JSON.
 
@@ -102,10 +202,10 @@ class DatabaseAdapter:
             raw_data: Data to serialize
 
         Returns:
-            JSON string representation
+            JSON string representation, or None (stored as NULL) when there is no data
         """
         if not raw_data:
-            return "{}"
+            return None
 
         try:
             return json.dumps(raw_data)
@@ -231,14 +331,18 @@ class DatabaseAdapter:
             folder_id: If set, only chats in this folder
         """
         async with self.db_manager.async_session_factory() as session:
-            # Subquery for last message date
-            subq = (
-                select(Message.chat_id, func.max(Message.date).label("last_message_date"))
-                .group_by(Message.chat_id)
-                .subquery()
+            # Last message date per chat: one idx_messages_chat_date_desc seek per chat,
+            # instead of grouping the whole messages table
+            last_message_date = (
+                select(Message.date)
+                .where(Message.chat_id == Chat.id)
+                .order_by(Message.date.desc())
+                .limit(1)
+                .scalar_subquery()
+                .label("last_message_date")
             )
 
-            stmt = select(Chat, subq.c.last_message_date).outerjoin(subq, Chat.id == subq.c.chat_id)
+            stmt = select(Chat, last_message_date)
 
             # Filter by folder membership
             if folder_id is not None:
@@ -248,7 +352,8 @@ class DatabaseAdapter:
 
             # Filter by archived status
             if archived is True:
-                stmt = stmt.where(Chat.is_archived == 1)
+                # Literal so the partial idx_chats_archived applies
+                stmt = stmt.where(Chat.is_archived == literal_column("1"))
             elif archived is False:
                 stmt = stmt.where(or_(Chat.is_archived == 0, Chat.is_archived.is_(None)))
 
@@ -265,7 +370,7 @@ class DatabaseAdapter:
                 )
 
             # Order by last message date
-            stmt = stmt.order_by(subq.c.last_message_date.is_(None), subq.c.last_message_date.desc())
+            stmt = stmt.order_by(last_message_date.is_(None), last_message_date.desc())
 
             # Apply pagination if limit is specified
             if limit is not None:
@@ -313,7 +418,8 @@ class DatabaseAdapter:
                 )
 
             if archived is True:
-                stmt = stmt.where(Chat.is_archived == 1)
+                # Literal so the partial idx_chats_archived applies
+                stmt = stmt.where(Chat.is_archived == literal_column("1"))
             elif archived is False:
                 stmt = stmt.where(or_(Chat.is_archived == 0, Chat.is_archived.is_(None)))
 
@@ -346,34 +452,7 @@ class DatabaseAdapter:
                 "updated_at": datetime.utcnow(),
             }
 
-            if self._is_sqlite:
-                stmt = sqlite_insert(User).values(**values)
-                stmt = stmt.on_conflict_do_update(
-                    index_elements=["id"],
-                    set_={
-                        "username": stmt.excluded.username,
-                        "first_name": stmt.excluded.first_name,
-                        "last_name": stmt.excluded.last_name,
-                        "phone": stmt.excluded.phone,
-                        "is_bot": stmt.excluded.is_bot,
-                        "updated_at": datetime.utcnow(),
-                    },
-                )
-            else:
-                stmt = pg_insert(User).values(**values)
-                stmt = stmt.on_conflict_do_update(
-                    index_elements=["id"],
-                    set_={
-                        "username": stmt.excluded.username,
-                        "first_name": stmt.excluded.first_name,
-                        "last_name": stmt.excluded.last_name,
-                        "phone": stmt.excluded.phone,
-                        "is_bot": stmt.excluded.is_bot,
-                        "updated_at": datetime.utcnow(),
-                    },
-                )
-
-            await session.execute(stmt)
+            await session.execute(self._upsert_user, values)
             await session.commit()
 
     # ========== Message Operations ==========
@@ -399,14 +478,7 @@ class DatabaseAdapter:
                 "is_outgoing": message_data.get("is_outgoing", 0),
             }
 
-            if self._is_sqlite:
-                stmt = sqlite_insert(Message).values(**values)
-                stmt = stmt.on_conflict_do_update(index_elements=["id", "chat_id"], set_=values)
-            else:
-                stmt = pg_insert(Message).values(**values)
-                stmt = stmt.on_conflict_do_update(index_elements=["id", "chat_id"], set_=values)
-
-            await session.execute(stmt)
+            await session.execute(self._upsert_message, values)
             await session.commit()
 
     @retry_on_locked()
@@ -418,33 +490,28 @@ class DatabaseAdapter:
         if not messages_data:
             return
 
-        async with self.db_manager.async_session_factory() as session:
-            for m in messages_data:
-                values = {
-                    "id": m["id"],
-                    "chat_id": m["chat_id"],
-                    "sender_id": m.get("sender_id"),
-                    "date": _strip_tz(m["date"]),
-                    "text": m.get("text"),
-                    "reply_to_msg_id": m.get("reply_to_msg_id"),
-                    "reply_to_top_id": m.get("reply_to_top_id"),
-                    "reply_to_text": m.get("reply_to_text"),
-                    "forward_from_id": m.get("forward_from_id"),
-                    "edit_date": _strip_tz(m.get("edit_date")),
-                    "raw_data": self._serialize_raw_data(m.get("raw_data", {})),
-                    "is_outgoing": m.get("is_outgoing", 0),
-                    "is_pinned": m.get("is_pinned", 0),
-                }
-
-                if self._is_sqlite:
-                    stmt = sqlite_insert(Message).values(**values)
-                    stmt = stmt.on_conflict_do_update(index_elements=["id", "chat_id"], set_=values)
-                else:
-                    stmt = pg_insert(Message).values(**values)
-                    stmt = stmt.on_conflict_do_update(index_elements=["id", "chat_id"], set_=values)
-
-                await session.execute(stmt)
+        rows = [
+            {
+                "id": m["id"],
+                "chat_id": m["chat_id"],
+                "sender_id": m.get("sender_id"),
+                "date": _strip_tz(m["date"]),
+                "text": m.get("text"),
+                "reply_to_msg_id": m.get("reply_to_msg_id"),
+                "reply_to_top_id": m.get("reply_to_top_id"),
+                "reply_to_text": m.get("reply_to_text"),
+                "forward_from_id": m.get("forward_from_id"),
+                "edit_date": _strip_tz(m.get("edit_date")),
+                "raw_data": self._serialize_raw_data(m.get("raw_data", {})),
+                "is_outgoing": m.get("is_outgoing", 0),
+                "is_pinned": m.get("is_pinned", 0),
+            }
+            for m in messages_data
+        ]
 
+        async with self.db_manager.async_session_factory() as session:
+            # executemany: one statement, every row bound in a single call
+            await session.execute(self._upsert_message_pinned, rows)
             await session.commit()
 
     async def get_messages_by_date_range(
@@ -646,33 +713,39 @@ class DatabaseAdapter:
 
     # ========== Media Operations ==========
 
+    @staticmethod
+    def _media_values(media_data: dict[str, Any]) -> dict[str, Any]:
+        """Column values for a media upsert."""
+        return {
+            "id": media_data["id"],
+            "message_id": media_data.get("message_id"),
+            "chat_id": media_data.get("chat_id"),
+            "type": media_data["type"],
+            "file_name": media_data.get("file_name"),
+            "file_path": media_data.get("file_path"),
+            "file_size": media_data.get("file_size"),
+            "mime_type": media_data.get("mime_type"),
+            "width": media_data.get("width"),
+            "height": media_data.get("height"),
+            "duration": media_data.get("duration"),
+            "downloaded": 1 if media_data.get("downloaded") else 0,
+            "download_date": media_data.get("download_date"),
+        }
+
     async def insert_media(self, media_data: dict[str, Any]) -> None:
         """Insert a media file record."""
         async with self.db_manager.async_session_factory() as session:
-            values = {
-                "id": media_data["id"],
-                "message_id": media_data.get("message_id"),
-                "chat_id": media_data.get("chat_id"),
-                "type": media_data["type"],
-                "file_name": media_data.get("file_name"),
-                "file_path": media_data.get("file_path"),
-                "file_size": media_data.get("file_size"),
-                "mime_type": media_data.get("mime_type"),
-                "width": media_data.get("width"),
-                "height": media_data.get("height"),
-                "duration": media_data.get("duration"),
-                "downloaded": 1 if media_data.get("downloaded") else 0,
-                "download_date": media_data.get("download_date"),
-            }
+            await session.execute(self._upsert_media, self._media_values(media_data))
+            await session.commit()
 
-            if self._is_sqlite:
-                stmt = sqlite_insert(Media).values(**values)
-                stmt = stmt.on_conflict_do_update(index_elements=["id"], set_=values)
-            else:
-                stmt = pg_insert(Media).values(**values)
-                stmt = stmt.on_conflict_do_update(index_elements=["id"], set_=values)
+    @retry_on_locked()
+    async def insert_media_batch(self, media_list: list[dict[str, Any]]) -> None:
+        """Insert multiple media file records in a single transaction."""
+        if not media_list:
+            return
 
-            await session.execute(stmt)
+        async with self.db_manager.async_session_factory() as session:
+            await session.execute(self._upsert_media, [self._media_values(media_data) for media_data in media_list])
             await session.commit()
 
     async def get_media_for_chat(self, chat_id: int) -> list[dict[str, Any]]:
@@ -880,10 +953,17 @@ class DatabaseAdapter:
 
     async def get_cached_statistics(self) -> dict[str, Any]:
         """Get cached statistics (fast, no expensive queries)."""
-        # Get cached stats from metadata
-        cached_stats = await self.get_metadata("cached_stats")
-        stats_calculated_at = await self.get_metadata("stats_calculated_at")
-        last_backup_time = await self.get_metadata("last_backup_time")
+        # Get cached stats from metadata (all three keys in one query)
+        async with self.db_manager.async_session_factory() as session:
+            rows = await session.execute(
+                select(Metadata.key, Metadata.value).where(
+                    Metadata.key.in_(["cached_stats", "stats_calculated_at", "last_backup_time"])
+                )
+            )
+            metadata = dict(rows.tuples().all())
+        cached_stats = metadata.get("cached_stats")
+        stats_calculated_at = metadata.get("stats_calculated_at")
+        last_backup_time = metadata.get("last_backup_time")
 
         result = {
             "chats": 0,
@@ -915,21 +995,17 @@ class DatabaseAdapter:
         async with self.db_manager.async_session_factory() as session:
             logger.info("Calculating statistics (this may take a while)...")
 
-            # Chat count
-            chat_count = await session.execute(select(func.count(Chat.id)))
-            chat_count = chat_count.scalar() or 0
-
-            # Message count
-            msg_count = await session.execute(select(func.count()).select_from(Message))
-            msg_count = msg_count.scalar() or 0
-
-            # Media count
-            media_count = await session.execute(select(func.count(Media.id)).where(Media.downloaded == 1))
-            media_count = media_count.scalar() or 0
-
-            # Total media size
-            total_size = await session.execute(select(func.sum(Media.file_size)).where(Media.downloaded == 1))
-            total_size = total_size.scalar() or 0
+            # Chat count, downloaded media count and size - one statement, one pass over media
+            totals = await session.execute(
+                select(
+                    select(func.count(Chat.id)).scalar_subquery(),
+                    func.count(Media.id).filter(Media.downloaded == 1),
+                    func.sum(Media.file_size).filter(Media.downloaded == 1),
+                ).select_from(Media)
+            )
+            chat_count, media_count, total_size = totals.one()
+            media_count = media_count or 0
+            total_size = total_size or 0
 
             # Per-chat statistics
             chat_stats_query = select(Message.chat_id, func.count(Message.id).label("message_count")).group_by(
@@ -938,6 +1014,9 @@ class DatabaseAdapter:
             chat_stats_result = await session.execute(chat_stats_query)
             per_chat_stats = {row.chat_id: row.message_count for row in chat_stats_result}
 
+            # Message count - every message has a chat, so the per-chat counts add up to it
+            msg_count = sum(per_chat_stats.values())
+
             stats = {
                 "chats": int(chat_count),
                 "messages": int(msg_count),
@@ -967,36 +1046,18 @@ class DatabaseAdapter:
             await session.execute(delete(Message).where(Message.chat_id == chat_id))
             # Delete sync status
             await session.execute(delete(SyncStatus).where(SyncStatus.chat_id == chat_id))
+            # Delete chat-specific push subscriptions (FK cascades on PostgreSQL; SQLite
+            # does not enforce foreign keys on these connections)
+            await session.execute(delete(PushSubscription).where(PushSubscription.chat_id == chat_id))
             # Delete chat
             await session.execute(delete(Chat).where(Chat.id == chat_id))
 
             await session.commit()
             logger.info(f"Deleted chat {chat_id} and all related data from database")
 
-        # Delete physical files
+        # Delete physical files - off the event loop, a media folder can hold thousands of files
         if media_base_path and os.path.exists(media_base_path):
-            chat_media_dir = os.path.join(media_base_path, str(chat_id))
-            if os.path.exists(chat_media_dir):
-                try:
-                    shutil.rmtree(chat_media_dir)
-                    logger.info(f"Deleted media folder: {chat_media_dir}")
-                except Exception as e:
-                    logger.error(f"Failed to delete media folder {chat_media_dir}: {e}")
-
-            for avatar_type in ["chats", "users"]:
-                avatar_pattern = os.path.join(media_base_path, "avatars", avatar_type, f"{chat_id}_*.jpg")
-                avatar_files = glob.glob(avatar_pattern)
-
-                # Legacy fallback: remove old <chat_id>.jpg files as well
-                legacy_avatar = os.path.join(media_base_path, "avatars", avatar_type, f"{chat_id}.jpg")
-                if os.path.exists(legacy_avatar):
-                    avatar_files.append(legacy_avatar)
-                for avatar_file in avatar_files:
-                    try:
-                        os.remove(avatar_file)
-                        logger.info(f"Deleted avatar file: {avatar_file}")
-                    except Exception as e:
-                        logger.error(f"Failed to delete avatar {avatar_file}: {e}")
+            await asyncio.to_thread(_delete_chat_files, media_base_path, chat_id)
 
     # ========== Web Viewer Operations ==========
 
@@ -1074,8 +1135,9 @@ class DatabaseAdapter:
                     stmt = stmt.where(Message.date < before_date)
                 stmt = stmt.order_by(Message.date.desc(), Message.id.desc()).limit(limit)
             else:
-                # Offset-based pagination (legacy fallback)
-                stmt = stmt.order_by(Message.date.desc()).limit(limit).offset(offset)
+                # Offset-based pagination (legacy fallback). Same ORDER BY as the cursor
+                # path so both walk idx_messages_chat_date_desc without a sort step.
+                stmt = stmt.order_by(Message.date.desc(), Message.id.desc()).limit(limit).offset(offset)
 
             result = await session.execute(stmt)
             messages = []
@@ -1289,7 +1351,8 @@ class DatabaseAdapter:
                 .outerjoin(User, Message.sender_id == User.id)
                 .outerjoin(Media, and_(Media.message_id == Message.id, Media.chat_id == Message.chat_id))
                 .where(Message.chat_id == chat_id)
-                .where(Message.is_pinned == 1)
+                # Literal (not bound) so the planner can match the partial idx_messages_chat_pinned
+                .where(Message.is_pinned == literal_column("1"))
                 .order_by(Message.date.desc())
             )
 
@@ -1344,7 +1407,10 @@ class DatabaseAdapter:
         async with self.db_manager.async_session_factory() as session:
             # First, unpin all messages in this chat
             await session.execute(
-                update(Message).where(Message.chat_id == chat_id).where(Message.is_pinned == 1).values(is_pinned=0)
+                update(Message)
+                .where(Message.chat_id == chat_id)
+                .where(Message.is_pinned == literal_column("1"))
+                .values(is_pinned=0)
             )
 
             # Then, pin the specified messages (if any exist in our database)
@@ -1406,7 +1472,8 @@ class DatabaseAdapter:
             include_media: If True, include media info from media table
 
         Yields:
-            Message dictionaries with user info
+            Message dictionaries with user info, oldest first (ORDER BY date ASC,
+            a backward scan of idx_messages_chat_date_desc) - callers rely on this order
         """
         async with self.db_manager.async_session_factory() as session:
             if include_media:
@@ -1646,7 +1713,7 @@ class DatabaseAdapter:
     async def get_archived_chat_count(self) -> int:
         """Get the count of archived chats."""
         async with self.db_manager.async_session_factory() as session:
-            result = await session.execute(select(func.count(Chat.id)).where(Chat.is_archived == 1))
+            result = await session.execute(select(func.count(Chat.id)).where(Chat.is_archived == literal_column("1")))
             return result.scalar() or 0
 
     async def close(self) -> None:
@@ -12,7 +12,7 @@ from urllib.parse import quote_plus
 
 from sqlalchemy import event, text
 from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
-from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from .models import Base
 
@@ -105,11 +105,18 @@ class DatabaseManager:
 
         # Engine configuration differs by database type
         if self._is_sqlite:
-            # SQLite: Use NullPool for better async compatibility
+            # SQLite: keep a small pool of connections so each session reuses an open
+            # connection (and its PRAGMAs, page cache and mmap) instead of reconnecting.
+            # WAL lets the pooled connections read in parallel; writers still take
+            # turns on the database lock (busy_timeout). Every idle pooled connection
+            # keeps its page cache (cache_size, up to 64MB), so only 2 stay open; bursts
+            # get up to 2 more that are closed as soon as they are returned.
             self.engine = create_async_engine(
                 self.database_url,
                 echo=os.getenv("DB_ECHO", "false").lower() == "true",
-                poolclass=NullPool,
+                poolclass=AsyncAdaptedQueuePool,
+                pool_size=2,
+                max_overflow=2,
             )
             # Set up SQLite-specific pragmas
             self._setup_sqlite_pragmas()
@@ -172,6 +179,10 @@ class DatabaseManager:
                 cursor.execute("PRAGMA busy_timeout=60000")
                 # 64MB cache for better performance
                 cursor.execute("PRAGMA cache_size=-64000")
+                # Sorts/temp indexes in RAM instead of temp files
+                cursor.execute("PRAGMA temp_store=MEMORY")
+                # Read pages through a 1GB memory map instead of read() syscalls
+                cursor.execute("PRAGMA mmap_size=1073741824")
             except Exception:
                 pass  # Read-only PRAGMAs are non-critical
             cursor.close()
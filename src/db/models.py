@@ -19,6 +19,7 @@ from sqlalchemy import (
     UniqueConstraint,
     func,
 )
+from sqlalchemy import text as sql_text  # aliased: Message has a "text" column
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -55,7 +56,22 @@ class Chat(Base):
     sync_status: Mapped[SyncStatus | None] = relationship("SyncStatus", back_populates="chat", uselist=False)
     forum_topics: Mapped[list[ForumTopic]] = relationship("ForumTopic", back_populates="chat", lazy="dynamic")
 
-    __table_args__ = (Index("idx_chats_username", "username"),)
+    __table_args__ = (
+        # Partial (non-null only); not unique since Telegram usernames get reused
+        Index(
+            "idx_chats_username",
+            "username",
+            sqlite_where=sql_text("username IS NOT NULL"),
+            postgresql_where=sql_text("username IS NOT NULL"),
+        ),
+        # Partial index for the archived chats list (only archived chats are indexed)
+        Index(
+            "idx_chats_archived",
+            "id",
+            sqlite_where=sql_text("is_archived = 1"),
+            postgresql_where=sql_text("is_archived = 1"),
+        ),
+    )
 
 
 class Message(Base):
@@ -97,17 +113,44 @@ class Message(Base):
     media_items: Mapped[list[Media]] = relationship("Media", back_populates="message", lazy="selectin")
 
     __table_args__ = (
-        Index("idx_messages_chat_id", "chat_id"),
         Index("idx_messages_date", "date"),
         Index("idx_messages_sender_id", "sender_id"),
-        # Composite index for fast pagination: WHERE chat_id = ? ORDER BY date DESC
-        Index("idx_messages_chat_date_desc", "chat_id", date.desc()),
-        # Index for finding pinned messages in a chat
-        Index("idx_messages_chat_pinned", "chat_id", "is_pinned"),
-        # Index for reply lookups
-        Index("idx_messages_reply_to", "chat_id", "reply_to_msg_id"),
-        # v6.2.0: Index for topic message lookups in forum chats
-        Index("idx_messages_topic", "chat_id", "reply_to_top_id"),
+        # Composite index for keyset pagination: WHERE chat_id = ? ORDER BY date DESC, id DESC
+        # PostgreSQL: narrow columns INCLUDEd for index-only scans (text is too wide for a btree tuple)
+        Index(
+            "idx_messages_chat_date_desc",
+            "chat_id",
+            date.desc(),
+            id.desc(),
+            postgresql_include=["sender_id", "reply_to_msg_id", "is_pinned"],
+        ),
+        # Partial index for finding pinned messages in a chat (only pinned rows are indexed)
+        Index(
+            "idx_messages_chat_pinned",
+            "chat_id",
+            sqlite_where=sql_text("is_pinned = 1"),
+            postgresql_where=sql_text("is_pinned = 1"),
+        ),
+        # Index for reply lookups, newest first (partial: replies only)
+        Index(
+            "idx_messages_reply_to",
+            "chat_id",
+            "reply_to_msg_id",
+            date.desc(),
+            id.desc(),
+            sqlite_where=sql_text("reply_to_msg_id IS NOT NULL"),
+            postgresql_where=sql_text("reply_to_msg_id IS NOT NULL"),
+        ),
+        # v6.2.0: Index for topic message lookups in forum chats (partial: forum messages only)
+        Index(
+            "idx_messages_topic",
+            "chat_id",
+            "reply_to_top_id",
+            date.desc(),
+            id.desc(),
+            sqlite_where=sql_text("reply_to_top_id IS NOT NULL"),
+            postgresql_where=sql_text("reply_to_top_id IS NOT NULL"),
+        ),
     )
 
 
@@ -137,7 +180,25 @@ class User(Base):
         lazy="dynamic",
     )
 
-    __table_args__ = (Index("idx_users_username", "username"),)
+    __table_args__ = (
+        # Partial (non-null only); not unique since Telegram usernames get reused
+        Index(
+            "idx_users_username",
+            "username",
+            sqlite_where=sql_text("username IS NOT NULL"),
+            postgresql_where=sql_text("username IS NOT NULL"),
+        ),
+    )
+
+
+# Media types that have actual files on disk (geo, poll, contact, venue, ... are metadata only)
+DOWNLOADABLE_MEDIA_TYPES = ("photo", "video", "audio", "voice", "document", "sticker", "animation")
+
+# Downloadable media whose size was never recorded. Spelled out with literals so that
+# queries written the same way can use the idx_media_needs_size partial index.
+MEDIA_NEEDS_SIZE_WHERE = (
+    "type IN (" + ", ".join(f"'{t}'" for t in DOWNLOADABLE_MEDIA_TYPES) + ") AND (file_size IS NULL OR file_size = 0)"
+)
 
 
 class Media(Base):
@@ -179,6 +240,15 @@ class Media(Base):
         Index("idx_media_message", "message_id", "chat_id"),
         Index("idx_media_downloaded", "chat_id", "downloaded"),
         Index("idx_media_type", "type"),
+        # Partial index for scripts/update_media_sizes.py: downloadable media with no recorded size,
+        # in the chat-by-chat order the script reads them
+        Index(
+            "idx_media_needs_size",
+            "chat_id",
+            "file_name",
+            sqlite_where=sql_text(MEDIA_NEEDS_SIZE_WHERE),
+            postgresql_where=sql_text(MEDIA_NEEDS_SIZE_WHERE),
+        ),
     )
 
 
@@ -209,7 +279,13 @@ class Reaction(Base):
         ),
         UniqueConstraint("message_id", "chat_id", "emoji", "user_id", name="uq_reaction"),
         Index("idx_reactions_message", "message_id", "chat_id"),
-        Index("idx_reactions_user", "user_id"),
+        # Partial: reactions without a user_id are never looked up by user
+        Index(
+            "idx_reactions_user",
+            "user_id",
+            sqlite_where=sql_text("user_id IS NOT NULL"),
+            postgresql_where=sql_text("user_id IS NOT NULL"),
+        ),
     )
 
 
@@ -245,7 +321,9 @@ class PushSubscription(Base):
     endpoint: Mapped[str] = mapped_column(Text, nullable=False, unique=True)  # Push service URL
     p256dh: Mapped[str] = mapped_column(String(255), nullable=False)  # Public key
     auth: Mapped[str] = mapped_column(String(255), nullable=False)  # Auth secret
-    chat_id: Mapped[int | None] = mapped_column(BigInteger)  # Optional: subscribe to specific chat only
+    chat_id: Mapped[int | None] = mapped_column(
+        BigInteger, ForeignKey("chats.id", ondelete="CASCADE")
+    )  # Optional: subscribe to specific chat only
     user_agent: Mapped[str | None] = mapped_column(String(500))  # Browser info for debugging
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, server_default=func.now())
     last_used_at: Mapped[datetime | None] = mapped_column(DateTime)  # Track activity
@@ -277,7 +355,11 @@ class ForumTopic(Base):
     # Relationships
     chat: Mapped[Chat] = relationship("Chat", back_populates="forum_topics")
 
-    __table_args__ = (Index("idx_forum_topics_chat", "chat_id"),)
+    __table_args__ = (
+        Index("idx_forum_topics_chat", "chat_id"),
+        # SQLite: composite PK is the storage key (no separate rowid b-tree)
+        {"sqlite_with_rowid": False},
+    )
 
 
 class ChatFolder(Base):
@@ -317,6 +399,7 @@ class ChatFolderMember(Base):
     chat: Mapped[Chat] = relationship("Chat")
 
     __table_args__ = (
-        Index("idx_folder_members_chat", "chat_id"),
-        Index("idx_folder_members_folder", "folder_id"),
+        # Folder-side lookups use the (folder_id, chat_id) primary key
+        Index("idx_folder_members_chat", "chat_id", "folder_id"),
+        {"sqlite_with_rowid": False},
     )
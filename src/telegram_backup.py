@@ -54,6 +54,7 @@ class TelegramBackup:
         self.client: TelegramClient | None = client
         self._owns_client = client is None  # Track if we created the client
         self._cleaned_media_chats: set[int] = set()  # Track chats already cleaned this session
+        self._saved_users: dict[int, dict] = {}  # user_id -> data last upserted this session
 
         logger.info("TelegramBackup initialized")
 
@@ -669,9 +670,8 @@ class TelegramBackup:
         """Persist a batch of processed messages, their media and reactions to the DB."""
         await self.db.insert_messages_batch(batch_data)
 
-        for msg in batch_data:
-            if msg.get("_media_data"):
-                await self.db.insert_media(msg["_media_data"])
+        # All of the batch's media in one transaction, not one commit per file
+        await self.db.insert_media_batch([msg["_media_data"] for msg in batch_data if msg.get("_media_data")])
 
         for msg in batch_data:
             if msg.get("reactions"):
@@ -843,8 +843,10 @@ class TelegramBackup:
         # Save sender information if available
         if message.sender:
             sender_data = self._extract_user_data(message.sender)
-            if sender_data:
+            # Only write a sender once per session unless their details change
+            if sender_data and self._saved_users.get(sender_data["id"]) != sender_data:
                 await self.db.upsert_user(sender_data)
+                self._saved_users[sender_data["id"]] = sender_data
 
         # Extract message data
         # v6.0.0: media_type, media_id, media_path removed - media stored in separate table
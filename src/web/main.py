@@ -597,12 +597,13 @@ async def get_messages(
     Get messages for a specific chat with user and media info.
 
     Supports two pagination modes:
-    - Offset-based: ?offset=100 (slower for large offsets)
+    - Offset-based: ?offset=100 (legacy, cost grows with the offset)
     - Cursor-based: ?before_date=2026-01-15T12:00:00&before_id=12345 (O(1) performance)
 
     v6.2.0: Added topic_id filter for forum topic messages.
 
-    Cursor-based pagination is preferred for infinite scroll.
+    Cursor-based pagination is preferred for infinite scroll and search; the viewer
+    always pages with the (date, id) of the oldest message it has loaded.
     """
     # Restrict access in display mode
     if config.display_chat_ids and chat_id not in config.display_chat_ids:
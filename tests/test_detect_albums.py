@@ -0,0 +1,70 @@
+"""Tests for album boundary detection in scripts/detect_albums.py."""
+
+import os
+import sys
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from scripts import detect_albums
+
+T0 = datetime(2024, 5, 1, 12, 0, 0)
+
+
+def _msg(seconds, sender_id=1, already_grouped=False):
+    """Message row as read by detect_albums; seconds=None means no date."""
+    return SimpleNamespace(
+        date=None if seconds is None else T0 + timedelta(seconds=seconds),
+        sender_id=sender_id,
+        already_grouped=already_grouped,
+    )
+
+
+CASES = {
+    "empty": ([], []),
+    "single": ([_msg(0)], []),
+    "one_run": ([_msg(0), _msg(1), _msg(2)], [(0, 3)]),
+    "window_boundary_inclusive": ([_msg(0), _msg(2), _msg(4)], [(0, 3)]),
+    "window_exceeded": ([_msg(0), _msg(2), _msg(5), _msg(6)], [(0, 2), (2, 4)]),
+    "fractional_past_window": ([_msg(0), _msg(2.5)], []),
+    "sender_change": ([_msg(0, 1), _msg(1, 1), _msg(1, 2), _msg(2, 2)], [(0, 2), (2, 4)]),
+    "none_senders_join": ([_msg(0, None), _msg(1, None)], [(0, 2)]),
+    "none_vs_sender": ([_msg(0, None), _msg(1, 1)], []),
+    "missing_date_breaks_run": ([_msg(0), _msg(1), _msg(None), _msg(2), _msg(3)], [(0, 2), (3, 5)]),
+    "all_dates_missing": ([_msg(None), _msg(None)], []),
+    "already_grouped_breaks_run": (
+        [_msg(0), _msg(1), _msg(1, already_grouped=True), _msg(2), _msg(2)],
+        [(0, 2), (3, 5)],
+    ),
+    "already_grouped_pair": ([_msg(0, already_grouped=True), _msg(0, already_grouped=True)], []),
+    "negative_sender_ids": ([_msg(0, -1001), _msg(1, -1001), _msg(1, -1002)], [(0, 2)]),
+}
+
+
+def _runs(messages, use_numpy):
+    if use_numpy:
+        pytest.importorskip("numpy")
+        return detect_albums._album_runs(messages, 2)
+    with patch.object(detect_albums, "np", None):
+        return detect_albums._album_runs(messages, 2)
+
+
+class TestAlbumRuns:
+    """NumPy and pure-Python _album_runs must agree."""
+
+    @pytest.mark.parametrize("use_numpy", [True, False], ids=["numpy", "python"])
+    @pytest.mark.parametrize("case", CASES.keys())
+    def test_expected_runs(self, case, use_numpy):
+        messages, expected = CASES[case]
+        assert _runs(messages, use_numpy) == expected
+
+    @pytest.mark.parametrize("case", CASES.keys())
+    def test_branches_identical(self, case):
+        messages, _ = CASES[case]
+        runs = _runs(messages, use_numpy=True)
+        assert runs == _runs(messages, use_numpy=False)
+        assert all(type(bound) is int for run in runs for bound in run)
@@ -0,0 +1,150 @@
+"""Tests for the pure helpers in scripts/restore_chat.py."""
+
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from scripts.restore_chat import (
+    ALBUM_MAX_ITEMS,
+    ALBUM_WINDOW_SECONDS,
+    can_join_album,
+    msg_date_key,
+    parse_msg_date,
+)
+
+T0 = datetime(2024, 5, 1, 12, 0, 0)
+
+
+def _item(seconds=0, media_type="photo", sender_name="Alice", media_file="/media/f.jpg"):
+    """Item dict as built by restore_chat() for each message it sends."""
+    return {
+        "msg": {"media_type": media_type},
+        "sender_name": sender_name,
+        "date": None if seconds is None else T0 + timedelta(seconds=seconds),
+        "full_text": "",
+        "media_file": media_file,
+    }
+
+
+class TestCanJoinAlbum:
+    """Album grouping of consecutive media messages."""
+
+    def test_photos_and_videos_mix(self):
+        batch = [_item(0, "photo"), _item(1, "video")]
+        assert can_join_album(batch, _item(2, "photo"))
+
+    @pytest.mark.parametrize(
+        "last_type,next_type",
+        [("photo", "document"), ("document", "video"), ("document", "audio"), ("audio", "photo")],
+    )
+    def test_kinds_do_not_mix(self, last_type, next_type):
+        assert not can_join_album([_item(0, last_type)], _item(1, next_type))
+
+    @pytest.mark.parametrize("media_type", ["document", "audio"])
+    def test_same_kind_joins(self, media_type):
+        assert can_join_album([_item(0, media_type)], _item(1, media_type))
+
+    def test_unsupported_media_type(self):
+        assert not can_join_album([_item(0, "sticker")], _item(1, "sticker"))
+        assert not can_join_album([_item(0, None)], _item(1, None))
+
+    def test_mixed_run_splits_into_albums(self):
+        """photo, video, document, document, photo -> [photo, video], [document, document], [photo]."""
+        items = [
+            _item(0, "photo"),
+            _item(1, "video"),
+            _item(2, "document"),
+            _item(3, "document"),
+            _item(4, "photo"),
+        ]
+        albums = [[items[0]]]
+        for item in items[1:]:
+            if can_join_album(albums[-1], item):
+                albums[-1].append(item)
+            else:
+                albums.append([item])
+        assert [len(album) for album in albums] == [2, 2, 1]
+
+    def test_max_items_cap(self):
+        batch = [_item(i) for i in range(ALBUM_MAX_ITEMS - 1)]
+        assert can_join_album(batch, _item(ALBUM_MAX_ITEMS - 1))
+        batch.append(_item(ALBUM_MAX_ITEMS - 1))
+        assert not can_join_album(batch, _item(ALBUM_MAX_ITEMS))
+
+    def test_window_is_exclusive(self):
+        assert can_join_album([_item(0)], _item(ALBUM_WINDOW_SECONDS - 1))
+        assert not can_join_album([_item(0)], _item(ALBUM_WINDOW_SECONDS))
+
+    def test_window_measured_from_last_item(self):
+        batch = [_item(0), _item(50), _item(100)]
+        assert can_join_album(batch, _item(150))
+
+    def test_sender_change(self):
+        assert not can_join_album([_item(0, sender_name="Alice")], _item(1, sender_name="Bob"))
+
+    def test_missing_date(self):
+        assert not can_join_album([_item(None)], _item(1))
+        assert not can_join_album([_item(0)], _item(None))
+
+    def test_missing_media_file(self):
+        assert not can_join_album([_item(0, media_file=None)], _item(1))
+        assert not can_join_album([_item(0)], _item(1, media_file=None))
+
+
+DATE_STRINGS = [
+    "2024-01-01T00:00:00",
+    "2024-01-01T00:00:00Z",
+    "2024-01-01T00:00:00+00:00",
+    "2024-01-01T01:30:00+02:00",
+    "2024-01-01T00:30:00-05:00",
+    "2024-01-01T00:00:00.500000",
+    "2024-01-01T00:00:00.250000Z",
+    "2024-01-01T23:59:59+02:00",
+    "2023-12-31T23:59:59",
+    "2024-01-02T00:00:00Z",
+]
+
+CUTOFFS = [datetime(2024, 1, 1), datetime(2024, 1, 1, 0, 30), datetime(2024, 1, 2)]
+
+
+def _baseline(d):
+    """The pre-key comparison value: parse_msg_date(...).replace(tzinfo=None)."""
+    return parse_msg_date({"date": d}).replace(tzinfo=None)
+
+
+class TestMsgDateKey:
+    """String keys must order exactly like the parsed naive datetimes."""
+
+    @pytest.mark.parametrize(
+        "value,expected",
+        [
+            ("2024-01-01T10:00:00Z", "2024-01-01T10:00:00"),
+            ("2024-01-01T10:00:00+02:00", "2024-01-01T10:00:00"),
+            ("2024-01-01T10:00:00-05:00", "2024-01-01T10:00:00"),
+            ("2024-01-01T10:00:00", "2024-01-01T10:00:00"),
+            ("2024-01-01T10:00:00.123456+02:00", "2024-01-01T10:00:00.123456"),
+            (datetime(2024, 1, 1, 10, tzinfo=timezone(timedelta(hours=2))), "2024-01-01T10:00:00"),
+            (datetime(2024, 1, 1, 10), "2024-01-01T10:00:00"),
+            (None, None),
+            ("", None),
+        ],
+    )
+    def test_offset_stripped(self, value, expected):
+        assert msg_date_key({"date": value}) == expected
+
+    def test_sort_order_matches_baseline(self):
+        by_key = sorted(DATE_STRINGS, key=lambda d: (msg_date_key({"date": d}), d))
+        by_baseline = sorted(DATE_STRINGS, key=lambda d: (_baseline(d), d))
+        assert by_key == by_baseline
+
+    @pytest.mark.parametrize("cutoff", CUTOFFS, ids=lambda c: c.isoformat())
+    @pytest.mark.parametrize("value", DATE_STRINGS)
+    def test_after_before_filters_match_baseline(self, value, cutoff):
+        """--after/--before compare keys against cutoff.isoformat(), as restore_chat() does."""
+        key = msg_date_key({"date": value})
+        assert (key > cutoff.isoformat()) == (_baseline(value) > cutoff)
+        assert (key < cutoff.isoformat()) == (_baseline(value) < cutoff)
@@ -86,6 +86,19 @@ class TestWebMessagesAPIStructure(unittest.TestCase):
         self.assertEqual(default_offset, 0)
 
 
+class TestPaginationIndex(unittest.TestCase):
+    """Test the index backing keyset pagination."""
+
+    def test_chat_date_index_has_id_tiebreaker(self):
+        """idx_messages_chat_date_desc must match ORDER BY date DESC, id DESC."""
+        from src.db.models import Message
+
+        index = next(i for i in Message.__table__.indexes if i.name == "idx_messages_chat_date_desc")
+        expressions = [str(e) for e in index.expressions]
+
+        self.assertEqual(expressions, ["messages.chat_id", "messages.date DESC", "messages.id DESC"])
+
+
 class TestDatabaseAdapterWebMethods(unittest.TestCase):
     """Test DatabaseAdapter methods used by web API."""
 